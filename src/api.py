@@ -1,10 +1,15 @@
 """Some utility functions to access the AgileZen API (v1)."""
 
 import os.path
+import time
 import httplib
+import threading
 import json
+from collections import OrderedDict
 from ConfigParser import RawConfigParser
 
+from httppool import ConnectionPool, PoolException
+
 # AgileZen-related constants, read API key from cfg.
 CFG_PATH = os.path.join(os.path.dirname(__file__), '..', 'notify.cfg')
 CONFIG = RawConfigParser()
@@ -15,25 +20,48 @@ API_PATH_PREFIX = '/api/v1'
 API_HEADERS = {
     "X-Zen-ApiKey": API_KEY,
     "Content-Type": "application/json" }
-PROJECTS_URL = 'https://agilezen.com/api/v1/projects'
+PROJECTS_PATH = API_PATH_PREFIX + '/projects'
+
+# Keep-alive connections to the API are shared by all functions below.
+POOL_SIZE = 4
+if CONFIG.has_option('api', 'pool_size'):
+    POOL_SIZE = CONFIG.getint('api', 'pool_size')
+POOL_IDLE_TIMEOUT = 60
+if CONFIG.has_option('api', 'pool_idle_timeout'):
+    POOL_IDLE_TIMEOUT = CONFIG.getfloat('api', 'pool_idle_timeout')
+REQUEST_TIMEOUT = 30
+if CONFIG.has_option('api', 'timeout'):
+    REQUEST_TIMEOUT = CONFIG.getfloat('api', 'timeout')
+
+# Project roles are cached to avoid fetching them for each message/handler.
+PEOPLE_CACHE_TTL = 300
+if CONFIG.has_option('api', 'people_cache_ttl'):
+    PEOPLE_CACHE_TTL = CONFIG.getfloat('api', 'people_cache_ttl')
+PEOPLE_CACHE_SIZE = 200
+if CONFIG.has_option('api', 'people_cache_size'):
+    PEOPLE_CACHE_SIZE = CONFIG.getint('api', 'people_cache_size')
+
+# The list of projects is cached to resolve project names locally.
+PROJECTS_CACHE_TTL = 600
+if CONFIG.has_option('api', 'projects_cache_ttl'):
+    PROJECTS_CACHE_TTL = CONFIG.getfloat('api', 'projects_cache_ttl')
+# An unknown project name rebuilds the list at most every
+# PROJECTS_MISS_INTERVAL seconds.
+PROJECTS_MISS_INTERVAL = 60
+if CONFIG.has_option('api', 'projects_miss_interval'):
+    PROJECTS_MISS_INTERVAL = CONFIG.getfloat('api', 'projects_miss_interval')
 
 
 def get_projects():
     """Return a list of all projects."""
-    conn = httplib.HTTPSConnection(API_DOMAIN)
-    conn.request("GET", PROJECTS_URL, headers=API_HEADERS)
-    response = conn.getresponse().read()
-    return _parse_response(response)
+    return _get(PROJECTS_PATH)
 
-def get_people(project_id, role = None):
+def get_people(project_id, role = None, refresh = False):
     """Return a list of members (dictionaries) that have the given role
     in the project. If role is None, return all members.
+    The project's roles are cached, use refresh=True to bypass the cache.
     """
-    path = API_PATH_PREFIX + '/projects/' + str(project_id) + '?with=roles'
-    conn = httplib.HTTPSConnection(API_DOMAIN)
-    conn.request("GET", path, headers=API_HEADERS)
-    response = conn.getresponse().read()
-    data = _parse_response(response)
+    data = PEOPLE_CACHE.get(project_id, _get_project_roles, refresh)
     if role is not None:
         role_dict = _detect(lambda r: r['name'] == role, data['roles'])
         if (role_dict):
@@ -47,30 +75,48 @@ def get_people(project_id, role = None):
             result += each['members']
         return result
 
+def invalidate_people(project_id = None):
+    """Drop the cached roles of the project, or of all projects if
+    project_id is None.
+    """
+    PEOPLE_CACHE.invalidate(project_id)
+
+def _get_project_roles(project_id):
+    """Return the project including its roles and members."""
+    path = API_PATH_PREFIX + '/projects/' + str(project_id) + '?with=roles'
+    return _get(path)
+
 def get_story(project_id, story_id):
     """Return the details and comments of a story."""
     path = API_PATH_PREFIX
     path +='/projects/' + str(project_id) + '/stories/' + str(story_id)
     path += '?with=details,comments,tags'
-    conn = httplib.HTTPSConnection(API_DOMAIN)
-    conn.request("GET", path, headers=API_HEADERS)
-    response = conn.getresponse().read()
-    return _parse_response(response)
+    return _get(path)
 
-def get_active_project_ids():
+def get_active_project_ids(refresh = False):
     """Return a the IDs of all non-archived projects.""" 
-    data = get_projects()
-    return [int(project['id']) for project in data['items']]
+    if refresh:
+        PROJECT_INDEX.refresh()
+    return PROJECT_INDEX.active_ids()
     
 def lookup_project_id(name):
     """Return the project's ID with the given name.
     If not found raise exception.
     """
-    data = get_projects()
-    for project in data['items']:
-        if (project['name'] == name):
-            return int(project['id'])
-    raise APIException('Unknown project name ' + name)     
+    return PROJECT_INDEX.lookup(name)
+
+def _get(path):
+    """GET the path from the API through the shared connection pool and
+    return the parsed JSON data.
+    """
+    try:
+        status, response = POOL.request("GET", path, headers=API_HEADERS)
+    except PoolException as err:
+        raise APIException('Failed to connect to API: ' + str(err))
+    if status != httplib.OK:
+        raise APIException('API request failed with status '
+            + str(status) + ': ' + path)
+    return _parse_response(response)
 
 def _parse_response(response):
     """Try to parse the JSON response. Raises APIException on failure."""
@@ -90,4 +136,107 @@ def _detect(fun, seq):
 
 class APIException(Exception):
     """Raised when API is not accessible or data cannot be parsed."""
-    pass
\ No newline at end of file
+    pass
+
+
+class Cache():
+    """A thread-safe LRU cache whose entries expire after ttl seconds.
+    At most max_entries entries are kept, the least recently used ones
+    are evicted first.
+    """
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, load, refresh=False):
+        """Return the cached value for key. On a miss, if the entry has
+        expired or if refresh is true, call load(key) and cache its result.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and not refresh and entry[1] > now:
+                self._entries[key] = entry
+                return entry[0]
+        value = load(key)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, now + self.ttl)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, key=None):
+        """Drop the entry for key, or all entries if key is None."""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+
+class ProjectIndex():
+    """Index of the active projects by name, built from get_projects().
+    The index is rebuilt when it is older than ttl seconds or when a
+    project name cannot be found (e.g., the project was just created), at
+    most every miss_interval seconds. Names that are still unknown are
+    remembered until the index is rebuilt.
+    """
+
+    def __init__(self, ttl, miss_interval=PROJECTS_MISS_INTERVAL):
+        self.ttl = ttl
+        self.miss_interval = miss_interval
+        self._ids_by_name = {}
+        self._active_ids = []
+        self._unknown = set()
+        self._expires = 0
+        self._refreshed = 0
+        self._lock = threading.Lock()
+
+    def lookup(self, name):
+        """Return the ID of the project with the given name."""
+        self._refresh_if_expired()
+        project_id = self._ids_by_name.get(name)
+        if project_id is None and name not in self._unknown \
+                and time.time() >= self._refreshed + self.miss_interval:
+            self.refresh()
+            project_id = self._ids_by_name.get(name)
+        if project_id is None:
+            with self._lock:
+                self._unknown.add(name)
+            raise APIException('Unknown project name ' + name)
+        return project_id
+
+    def active_ids(self):
+        """Return a list with the IDs of all active projects."""
+        self._refresh_if_expired()
+        return list(self._active_ids)
+
+    def refresh(self):
+        """Download the list of projects and rebuild the index."""
+        data = get_projects()
+        ids_by_name = {}
+        active_ids = []
+        for project in data['items']:
+            project_id = int(project['id'])
+            ids_by_name[project['name']] = project_id
+            active_ids.append(project_id)
+        with self._lock:
+            self._ids_by_name = ids_by_name
+            self._active_ids = active_ids
+            self._unknown = set()
+            self._refreshed = time.time()
+            self._expires = self._refreshed + self.ttl
+
+    def _refresh_if_expired(self):
+        if self._expires <= time.time():
+            self.refresh()
+
+
+POOL = ConnectionPool(API_DOMAIN, POOL_SIZE, POOL_IDLE_TIMEOUT,
+    REQUEST_TIMEOUT, httplib.HTTPSConnection)
+PEOPLE_CACHE = Cache(PEOPLE_CACHE_TTL, PEOPLE_CACHE_SIZE)
+PROJECT_INDEX = ProjectIndex(PROJECTS_CACHE_TTL)
@@ -0,0 +1,309 @@
+"""Dispatches messages to the handlers on pools of worker threads, so that
+the XMPP event thread never waits for a handler's output I/O.
+
+Handlers are isolated from each other by type: a handler class can name the
+executor (a pool of worker threads) that runs it through its class attribute
+executor, e.g., executor = 'mail'. The number of workers per executor is
+configured in the [dispatch] section, handlers of unknown or unnamed
+executors run on the default executor.
+
+Each handler has its own bounded queue (a lane). A lane is processed by at
+most one worker at a time, hence each handler sees the messages in the order
+they arrived. When a lane is full, the configured backpressure policy
+decides what happens:
+
+- block: the dispatching thread waits until the handler caught up
+- drop_newest: the new message is dropped for this handler
+- drop_oldest: the oldest queued message is dropped for this handler
+"""
+
+import os.path
+import logging
+import threading
+import Queue
+from collections import deque
+from ConfigParser import RawConfigParser
+
+from registry import HandlerRegistry
+
+CFG_PATH = os.path.join(os.path.dirname(__file__), '..', 'notify.cfg')
+CONFIG = RawConfigParser()
+CONFIG.read(CFG_PATH)
+
+
+BLOCK = 'block'
+DROP_NEWEST = 'drop_newest'
+DROP_OLDEST = 'drop_oldest'
+POLICIES = (BLOCK, DROP_NEWEST, DROP_OLDEST)
+
+DEFAULT_EXECUTOR = 'default'
+
+
+def _parse_executors(spec):
+    """Parse a list of executor sizes like 'feed:1, mail:4'."""
+    result = {}
+    for item in spec.split(','):
+        if item.strip():
+            name, size = item.split(':')
+            result[name.strip()] = int(size)
+    return result
+
+WORKERS = 4
+if CONFIG.has_option('dispatch', 'workers'):
+    WORKERS = CONFIG.getint('dispatch', 'workers')
+EXECUTORS = _parse_executors('feed:1, mail:2, webhook:2')
+if CONFIG.has_option('dispatch', 'executors'):
+    EXECUTORS = _parse_executors(CONFIG.get('dispatch', 'executors'))
+QUEUE_SIZE = 100
+if CONFIG.has_option('dispatch', 'queue_size'):
+    QUEUE_SIZE = CONFIG.getint('dispatch', 'queue_size')
+WARM_UP_WORKERS = 4
+if CONFIG.has_option('dispatch', 'warm_up_workers'):
+    WARM_UP_WORKERS = CONFIG.getint('dispatch', 'warm_up_workers')
+BACKPRESSURE = BLOCK
+if CONFIG.has_option('dispatch', 'backpressure'):
+    BACKPRESSURE = CONFIG.get('dispatch', 'backpressure')
+
+LOG = logging.getLogger(__name__)
+
+
+class Dispatcher():
+    """Hands each message to the lanes of the handlers that may be
+    interested in it, which are processed by the executor of the handler.
+    handlers is a HandlerRegistry or a list of handlers.
+    """
+
+    def __init__(self, handlers, workers=WORKERS, queue_size=QUEUE_SIZE,
+            policy=BACKPRESSURE, executors=EXECUTORS):
+        if policy not in POLICIES:
+            raise ValueError('Unknown backpressure policy ' + policy)
+        self.policy = policy
+        self.executors = {}
+        for name, size in [(DEFAULT_EXECUTOR, workers)] + executors.items():
+            self.executors[name] = _Executor(name, size)
+        self.queue_size = queue_size
+        self.started = False
+        self.lanes = []
+        self._lanes_by_handler = {}
+        self.set_registry(handlers)
+
+    def set_registry(self, handlers):
+        """Dispatch subsequent messages to the given handlers (a registry
+        or a list). Handlers that were registered before keep their lane,
+        messages queued for removed handlers are still handled, then they
+        are closed. Added handlers that have a register_channels() method
+        register their outbox channels.
+        """
+        if not isinstance(handlers, HandlerRegistry):
+            handlers = HandlerRegistry(handlers)
+        lanes = []
+        lanes_by_handler = {}
+        added = []
+        for handler in handlers:
+            lane = self._lanes_by_handler.get(id(handler))
+            if lane is None:
+                added.append(handler)
+                register_channels = getattr(handler, 'register_channels',
+                    None)
+                if register_channels is not None:
+                    register_channels()
+                name = getattr(handler, 'executor', DEFAULT_EXECUTOR)
+                executor = self.executors.get(name,
+                    self.executors[DEFAULT_EXECUTOR])
+                lane = _Lane(handler, self.queue_size, executor)
+            lanes.append(lane)
+            lanes_by_handler[id(handler)] = lane
+        removed = [lane for key, lane in self._lanes_by_handler.items()
+            if key not in lanes_by_handler]
+        self.registry = handlers
+        self.lanes = lanes
+        self._lanes_by_handler = lanes_by_handler
+        for lane in removed:
+            lane.retire()
+        if self.started:
+            self.warm_up(added)
+
+    def start(self):
+        """Start the worker threads of all executors and warm up the
+        handlers in the background.
+        """
+        for executor in self.executors.values():
+            executor.start()
+        self.started = True
+        self.warm_up(self.registry)
+
+    def warm_up(self, handlers, workers=WARM_UP_WORKERS):
+        """Call warm_up() of the handlers that have one, in parallel on
+        background threads.
+        """
+        pending = Queue.Queue()
+        for handler in handlers:
+            if getattr(handler, 'warm_up', None) is not None:
+                pending.put(handler)
+        threads = [threading.Thread(target=_warm_up, args=(pending, ),
+                name='warm-up')
+            for _ in range(min(workers, pending.qsize()))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        return threads
+
+    def dispatch(self, message):
+        """Queue the message for the handlers that may be interested."""
+        for handler in self.registry.match(message):
+            lane = self._lanes_by_handler[id(handler)]
+            if lane.put(message, self.policy):
+                lane.executor.schedule(lane)
+
+    def stop(self):
+        """Wait until all queued messages are handled, stop the worker
+        threads and close the handlers that have a close() method.
+        """
+        for executor in self.executors.values():
+            executor.stop()
+        for handler in self.registry:
+            close = getattr(handler, 'close', None)
+            if close is not None:
+                close()
+
+    def queue_depths(self):
+        """Return a list of (executor name, handler, number of queued
+        messages) for each handler.
+        """
+        return [(lane.executor.name, lane.handler, len(lane))
+            for lane in self.lanes]
+
+
+def _close(handler):
+    """Close the handler if it has a close() method."""
+    close = getattr(handler, 'close', None)
+    if close is None:
+        return
+    try:
+        close()
+    except Exception:
+        LOG.exception('Failed to close %s', handler)
+
+def _warm_up(pending):
+    """Warm up handlers until there are no more pending."""
+    while True:
+        try:
+            handler = pending.get_nowait()
+        except Queue.Empty:
+            return
+        try:
+            handler.warm_up()
+        except Exception:
+            LOG.exception('Failed to warm up %s', handler)
+
+
+class _Executor():
+    """A pool of worker threads processing the lanes scheduled on it."""
+
+    def __init__(self, name, workers):
+        self.name = name
+        self._ready = Queue.Queue()
+        self._threads = [threading.Thread(target=self._work,
+                name='executor-' + name)
+            for _ in range(workers)]
+        for thread in self._threads:
+            thread.daemon = True
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def schedule(self, lane):
+        self._ready.put(lane)
+
+    def stop(self):
+        self._ready.join()
+        for _ in self._threads:
+            self._ready.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _work(self):
+        while True:
+            lane = self._ready.get()
+            if lane is None:
+                self._ready.task_done()
+                return
+            message = lane.take()
+            try:
+                lane.handler.handle(message)
+            except Exception:
+                LOG.exception('Handler %s failed on %s',
+                    lane.handler, message)
+            if lane.done():
+                self._ready.put(lane)
+            self._ready.task_done()
+
+
+class _Lane():
+    """The bounded queue of messages for a single handler."""
+
+    def __init__(self, handler, maxsize, executor):
+        self.handler = handler
+        self.maxsize = maxsize
+        self.executor = executor
+        self._pending = deque()
+        self._scheduled = False
+        self._retired = False
+        self._changed = threading.Condition()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def put(self, message, policy):
+        """Queue the message. Return true if the lane has to be scheduled
+        for processing (i.e., it was idle).
+        """
+        with self._changed:
+            if len(self._pending) >= self.maxsize:
+                if policy == DROP_NEWEST:
+                    LOG.warning('Queue of %s full, dropping %s',
+                        self.handler, message)
+                    return False
+                elif policy == DROP_OLDEST:
+                    dropped = self._pending.popleft()
+                    LOG.warning('Queue of %s full, dropping %s',
+                        self.handler, dropped)
+                else:
+                    while len(self._pending) >= self.maxsize:
+                        self._changed.wait()
+            self._pending.append(message)
+            if self._scheduled:
+                return False
+            self._scheduled = True
+            return True
+
+    def take(self):
+        """Remove and return the oldest message."""
+        with self._changed:
+            message = self._pending.popleft()
+            self._changed.notify_all()
+            return message
+
+    def retire(self):
+        """Close the handler once the queued messages are handled, called
+        when the handler was removed.
+        """
+        with self._changed:
+            busy = self._retired = self._scheduled
+        if not busy:
+            _close(self.handler)
+
+    def done(self):
+        """Called after a message was handled. Return true if the lane
+        has to be rescheduled because more messages are pending. The
+        handler of a retired lane is closed when none are left.
+        """
+        with self._changed:
+            if self._pending:
+                return True
+            self._scheduled = False
+            retired, self._retired = self._retired, False
+        if retired:
+            _close(self.handler)
+        return False
@@ -0,0 +1,47 @@
+"""A timer shared by the handlers that coalesce bursts of messages (feed
+writes, mail digests and webhook batches): the first message schedules a
+flush, further messages are added to it, and a flush for another reason
+(e.g., a full batch, or shutdown) cancels it.
+"""
+
+import threading
+
+
+class FlushTimer():
+    """Calls flush() on a daemon thread once the delay it was scheduled
+    with has passed. Scheduling it again before does not postpone the call.
+    The owner's lock must not be held when it is called by the timer, so
+    flush() has to acquire it.
+    """
+
+    def __init__(self, flush):
+        self.flush = flush
+        self._timer = None
+        self._lock = threading.Lock()
+
+    @property
+    def scheduled(self):
+        return self._timer is not None
+
+    def schedule(self, delay):
+        """Call flush() in delay seconds, unless it is already scheduled."""
+        with self._lock:
+            if self._timer is None:
+                self._timer = threading.Timer(delay, self._fire)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def cancel(self):
+        """Cancel the scheduled call, if any."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def _fire(self):
+        with self._lock:
+            # a call cancelled while starting is not made
+            if self._timer is not threading.current_thread():
+                return
+            self._timer = None
+        self.flush()
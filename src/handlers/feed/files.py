@@ -0,0 +1,65 @@
+"""Writing the feed files such that readers (e.g., the web server serving the
+feeds) never see partially written files.
+
+Files are written to a temporary file in the same directory, which is then
+renamed. The durability option in the [feed] section defines whether data is
+flushed to disk before returning:
+
+- none: no fsync, a crash may lose recent writes (but files are not torn)
+- file: fsync the file before renaming it
+- dir: additionally fsync the directory, so that the rename is durable
+"""
+
+import os
+import tempfile
+from ConfigParser import RawConfigParser
+
+CFG_PATH = os.path.join(
+    os.path.dirname(__file__), '..', '..', '..', 'notify.cfg')
+CONFIG = RawConfigParser()
+CONFIG.read(CFG_PATH)
+
+NONE = 'none'
+FILE = 'file'
+DIR = 'dir'
+DURABILITY = NONE
+if CONFIG.has_option('feed', 'durability'):
+    DURABILITY = CONFIG.get('feed', 'durability')
+if DURABILITY not in (NONE, FILE, DIR):
+    raise ValueError('Unknown durability ' + DURABILITY)
+
+# permissions of written files, as the web server has to read them
+FILE_MODE = 0644
+
+
+def write_atomically(path, write, durability=None):
+    """Call write(file) with a temporary file and rename it to path."""
+    durability = durability or DURABILITY
+    directory, filename = os.path.split(path)
+    fd, temp_path = tempfile.mkstemp(
+        prefix='.' + filename + '.', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            write(file)
+            flush(file, durability)
+        os.chmod(temp_path, FILE_MODE)
+        os.rename(temp_path, path)
+    except:
+        os.remove(temp_path)
+        raise
+    if durability == DIR:
+        sync_directory(directory)
+
+def flush(file, durability=None):
+    """Flush the file and, depending on durability, sync it to disk."""
+    file.flush()
+    if (durability or DURABILITY) != NONE:
+        os.fsync(file.fileno())
+
+def sync_directory(directory):
+    """Sync the directory (i.e., renames and new files in it) to disk."""
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
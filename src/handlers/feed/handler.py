@@ -1,13 +1,33 @@
 """A handler that writes messages to an RSS feed on disk.
 
 It caches a certain number of recent messages to persist them over restarts.
+The history of a feed is persisted in an append-only journal of message guids
+(see journal.py), the messages are kept in a store shared by all feeds
+(see store.py). Each entry of the feed is serialized once and kept as XML
+fragment in the store, writing the feed only serializes new entries. Files
+are replaced atomically (see files.py).
+
+Bursts of messages are coalesced: messages are persisted right away, but the
+feed is written at most every flush_interval seconds (see the [feed] section).
 """
 
 import os
+import time
 import pickle
+import logging
+import StringIO
+import threading
+import weakref
+from collections import deque
 from ConfigParser import RawConfigParser
 
 from feedgenerator import Atom1Feed
+from feedgenerator.django.utils.xmlutils import SimplerXMLGenerator
+
+from handlers.feed.files import write_atomically
+from handlers.feed.store import MessageStore
+from handlers.feed.journal import Journal
+from handlers.coalesce import FlushTimer
 
 # read config
 CFG_PATH = os.path.join(
@@ -19,93 +39,352 @@ FEED_DESCRIPTION = CONFIG.get('feed', 'description')
 AUTHOR_NAME = CONFIG.get('feed', 'author_name')
 AUTHOR_EMAIL = CONFIG.get('feed', 'author_email')
 MESSAGE_CACHE_SIZE = CONFIG.getint('feed', 'message_cache_size')
+JOURNAL_COMPACTION = 2
+
+# The feed is written at most every FLUSH_INTERVAL seconds, or when
+# FLUSH_PENDING messages were added since it was written.
+FLUSH_INTERVAL = 2.0
+if CONFIG.has_option('feed', 'flush_interval'):
+    FLUSH_INTERVAL = CONFIG.getfloat('feed', 'flush_interval')
+FLUSH_PENDING = 20
+if CONFIG.has_option('feed', 'flush_pending'):
+    FLUSH_PENDING = CONFIG.getint('feed', 'flush_pending')
+
+# A feed that handled no message for IDLE_TIMEOUT seconds releases its
+# messages from memory (0 keeps all feeds loaded). Every COLLECT_INTERVAL
+# seconds, the stored messages no feed refers to are deleted.
+IDLE_TIMEOUT = 3600
+if CONFIG.has_option('feed', 'idle_timeout'):
+    IDLE_TIMEOUT = CONFIG.getfloat('feed', 'idle_timeout')
+COLLECT_INTERVAL = 3600
+if CONFIG.has_option('feed', 'collect_interval'):
+    COLLECT_INTERVAL = CONFIG.getfloat('feed', 'collect_interval')
+JANITOR_INTERVAL = 60
 
 FEED_PATH = os.path.join(os.path.dirname(__file__), '..', '..', '..', 'feeds')
 
+# the messages of all feeds
+STORE = MessageStore(os.path.join(FEED_PATH, 'messages'))
+
+LOG = logging.getLogger(__name__)
+
 
 class FeedHandler():
+
+    executor = 'feed'
     
-    def __init__(self, title, filename, interested_in):
+    def __init__(self, title, filename, interested_in, store=None,
+            cache_size=None):
         self.title = title
         self.filename = filename
         self.interested_in = interested_in
-        self._load_messages()
-        self._generate_feed()
+        self.store = store if store is not None else STORE
+        self.cache_size = cache_size or MESSAGE_CACHE_SIZE
+        self.guids = deque(maxlen=self.cache_size)
+        self.journal = Journal(self._path('.journal'))
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._timer = FlushTimer(self.flush)
+        self._loaded = False
+        self._last_used = time.time()
+        JANITOR.watch(self)
+
+    def warm_up(self):
+        """Write the feed if it does not exist yet. Called in the background
+        on startup. Otherwise, the history is only loaded when the first
+        message is handled or the feed is flushed.
+        """
+        with self._lock:
+            if not os.path.exists(self._path('.xml')):
+                self._load()
         
     def handle(self, message):
         if self.interested_in(message):
-            self._remember(message)
-            self._generate_feed()
+            with self._lock:
+                self._last_used = time.time()
+                self._load()
+                self._remember(message)
+                self._pending += 1
+                if self._pending >= FLUSH_PENDING or FLUSH_INTERVAL <= 0:
+                    self._flush()
+                else:
+                    self._timer.schedule(FLUSH_INTERVAL)
+
+    def flush(self):
+        """Write the feed if messages were added since it was written."""
+        with self._lock:
+            self._load()
+            self._flush()
+
+    def close(self):
+        """Write pending messages, called on shutdown."""
+        with self._lock:
+            if self._loaded:
+                self._flush()
+
+    def release_if_idle(self, idle_timeout, now=None):
+        """Write pending messages and release the history from memory if
+        no message was handled for idle_timeout seconds. Return true if
+        the history was released.
+        """
+        now = now or time.time()
+        with self._lock:
+            if not self._loaded or now - self._last_used < idle_timeout:
+                return False
+            self._flush()
+            for guid in self.guids:
+                self.store.release(guid)
+            self.guids = deque(maxlen=self.cache_size)
+            self._loaded = False
+            return True
+
+    def referenced_guids(self):
+        """Return the guids of the messages in the feed, reading them from
+        the journal if the feed is not loaded.
+        """
+        with self._lock:
+            if self._loaded:
+                return list(self.guids)
+            if not self.journal.exists():
+                self._convert_pickle()
+            return self.journal.replay()[::-1][:self.cache_size]
+
+    def resize(self, cache_size):
+        """Change the number of cached messages. When shrinking, the oldest
+        messages are dropped.
+        """
+        with self._lock:
+            if not self._loaded:
+                self.cache_size = cache_size
+            if cache_size == self.cache_size:
+                return
+            guids = list(self.guids)
+            for guid in guids[cache_size:]:
+                self.store.release(guid)
+            self.cache_size = cache_size
+            self.guids = deque(guids[:cache_size], cache_size)
+            self.journal.rewrite(list(reversed(self.guids)))
+            self._flush(force=True)
+
+    def reconfigure(self, title, interested_in):
+        """Change the title and the rule of the feed (e.g., when the rules
+        changed). The feed is written again if the title changed.
+        """
+        with self._lock:
+            self.interested_in = interested_in
+            if title == self.title:
+                return
+            self.title = title
+            if self._loaded:
+                self._flush(force=True)
+
+    @property
+    def messages(self):
+        """The cached messages, newest first."""
+        return [self.store.get(guid) for guid in self.guids]
         
+    # load the history and write the feed once
+    def _load(self):
+        if not self._loaded:
+            self._load_messages()
+            self._generate_feed()
+            self._loaded = True
+
+    # write the feed and cancel the scheduled flush
+    def _flush(self, force=False):
+        self._timer.cancel()
+        if self._pending or force:
+            self._pending = 0
+            self._generate_feed()
+
     def _generate_feed(self):
         generator = self._create_generator()
-        for each in self.messages:
-            try:
-                author_name = each.causer
-            except AttributeError:
-                author_name = AUTHOR_NAME
-            generator.add(
-                title = each.title,
-                link = each.link,
-                description = each.content,
-                pubdate = each.pubdate,
-                unique_id = each.guid,
-                categories = each.categories,
-                author_name = author_name,
-                author_email = AUTHOR_EMAIL)
-        path = os.path.abspath(
-            os.path.join(FEED_PATH, self.filename + '.xml'))
-        file = open(path, 'w')
-        generator.write_string_to_file(file)
-        file.close()
+        create = lambda message: self._create_fragment(generator, message)
+        entries = [self.store.fragment(guid, create) for guid in self.guids]
+        updated = None
+        if self.guids:
+            updated = self.store.get(self.guids[0]).pubdate
+        write_atomically(self._path('.xml'), lambda file:
+            generator.write_string_to_file(file, entries, updated))
+
+    def _create_fragment(self, generator, message):
+        try:
+            author_name = message.causer
+        except AttributeError:
+            author_name = AUTHOR_NAME
+        return generator.entry(
+            title = message.title,
+            link = message.link,
+            description = message.content,
+            pubdate = message.pubdate,
+            unique_id = message.guid,
+            categories = message.categories,
+            author_name = author_name,
+            author_email = AUTHOR_EMAIL)
 
     def _create_generator(self):
         return FeedGenerator(
             self.title, FEED_BASE_URL + self.filename, FEED_DESCRIPTION)
 
-    # cache MESSAGE_CACHE_SIZE number of messages
+    # cache cache_size number of messages in a ring buffer (newest first),
+    # the messages themselves are kept in the shared store
     def _remember(self, message):
-        self.messages.insert(0, message)
-        self.messages = self.messages[:MESSAGE_CACHE_SIZE]
-        self._save_messages()
+        self.store.add(message)
+        if len(self.guids) == self.cache_size:
+            self.store.release(self.guids.pop())
+        self.guids.appendleft(message.guid)
+        self._save_message(message)
     
-    # persist the messsages as a pickle file
-    def _save_messages(self):
-        if len(self.messages) > 0:
-            file = open(self._backup_pickle_path(), 'wb')
-            pickle.dump(self.messages, file)
-            file.close()
+    # append the guid of the message to the journal, which is compacted
+    # when it grew to JOURNAL_COMPACTION times the number of cached messages
+    def _save_message(self, message):
+        self.journal.append(message.guid)
+        if self.journal.count > JOURNAL_COMPACTION * self.cache_size:
+            self.journal.rewrite(list(reversed(self.guids)))
             
-    # try to load messages from file system
+    # try to load messages from file system by replaying the journal
     # note, it's possible that these files don't exist 
     def _load_messages(self):
+        self.guids = deque(maxlen=self.cache_size)
+        if not self.journal.exists():
+            self._convert_pickle()
+        for guid in self.journal.replay()[::-1][:self.cache_size]:
+            if self.store.acquire(guid) is not None:
+                self.guids.append(guid)
+
+    # convert the pickle file of earlier versions to a journal, messages
+    # that cannot be converted are skipped, an unreadable file is renamed
+    def _convert_pickle(self):
+        path = self._path('.pkl')
+        try:
+            file = open(path, 'rb')
+        except IOError:
+            return
         try:
-            file = open(self._backup_pickle_path(), 'rb')
-            self.messages = pickle.load(file)
+            items = pickle.load(file)
+        except Exception:
+            LOG.exception('Cannot read %s, renaming it', path)
             file.close()
-        except IOError as e:
-            self.messages = []
+            os.rename(path, path + '.failed')
+            return
+        file.close()
+        guids = []
+        for item in items[:self.cache_size]:
+            try:
+                if isinstance(item, basestring):
+                    guids.append(item)
+                else:
+                    # even earlier versions pickled the messages
+                    self.store.put(item)
+                    guids.append(item.guid)
+            except Exception:
+                LOG.exception('Skipping message %r of %s', item, path)
+        self.journal.rewrite(guids[::-1])
+        os.remove(path)
+
+    def _path(self, extension):
+        return os.path.abspath(
+            os.path.join(FEED_PATH, self.filename + extension))
+
+
+class Janitor():
+    """Periodically releases the memory of idle feeds and deletes the
+    messages no feed refers to, on a background thread that is started
+    when the first feed is watched.
+    """
+
+    def __init__(self, interval=JANITOR_INTERVAL):
+        self.interval = interval
+        self.feeds = weakref.WeakSet()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._collected = time.time()
 
-    def _backup_pickle_path(self):
-        return os.path.abspath(os.path.join(
-            FEED_PATH, self.filename + '.pkl'))
+    def watch(self, feed):
+        with self._lock:
+            self.feeds.add(feed)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                    name='feed-janitor')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def run(self, now=None):
+        """Release idle feeds and, if it is due, collect garbage."""
+        now = now or time.time()
+        feeds = list(self.feeds)
+        if IDLE_TIMEOUT > 0:
+            for feed in feeds:
+                feed.release_if_idle(IDLE_TIMEOUT, now)
+        if now - self._collected >= COLLECT_INTERVAL:
+            self._collected = now
+            collect_garbage(feeds)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.run()
+            except Exception:
+                LOG.exception('Feed janitor failed')
+
+
+def collect_garbage(feeds):
+    """Delete the stored messages none of the feeds refers to. Return the
+    number of deleted messages.
+    """
+    stores = {}
+    for feed in feeds:
+        store, guids = stores.setdefault(id(feed.store), (feed.store, set()))
+        guids.update(feed.referenced_guids())
+    return sum(store.collect(guids) for store, guids in stores.values())
+
+
+JANITOR = Janitor()
 
 
 class FeedGenerator():
-    """A class that wraps the feedgenerator (creates an Atom feed)."""
+    """A class that wraps the feedgenerator (creates an Atom feed).
+    Entries are serialized separately, the feed is written from these
+    serialized entries.
+    """
     
     def __init__(self, title, link, description):
-        self.feed = Atom1Feed(
+        self.feed = _AtomFeed(
             title = title,
             link = link,
             description = description,
             language=u"en",
         )
 
-    def add(self, **event):
-        """Add an item to the feed."""
+    def entry(self, **event):
+        """Return the entry element (utf-8 encoded) for an item."""
+        self.feed.items = []
         self.feed.add_item(**event)
+        output = StringIO.StringIO()
+        self.feed.write_items(SimplerXMLGenerator(output, 'utf-8'))
+        self.feed.items = []
+        return output.getvalue()
+
+    def write_string_to_file(self, file, entries, updated=None):
+        """Export the feed with the given entries to a file. updated is the
+        date of the latest entry.
+        """
+        self.feed.updated = updated
+        document = self.feed.writeString('utf-8')
+        end = document.rindex('</feed>')
+        file.write(document[:end])
+        for entry in entries:
+            file.write(entry)
+        file.write(document[end:])
+
+
+class _AtomFeed(Atom1Feed):
+    """An Atom feed whose updated date can be set explicitly."""
+
+    updated = None
 
-    def write_string_to_file(self, file):
-        """Export the feed to a file."""
-        file.write(self.feed.writeString('utf-8'))
\ No newline at end of file
+    def latest_post_date(self):
+        if self.updated is not None:
+            return self.updated
+        return Atom1Feed.latest_post_date(self)
@@ -0,0 +1,74 @@
+"""An append-only journal, used to persist the history of a feed.
+
+Each record is pickled and prefixed with its length (4 bytes, big-endian).
+Appending a record is a single small write. A record that was only partly
+written (e.g., because of a crash) is discarded when the journal is
+replayed. The journal is compacted by rewriting it atomically with the
+records that are still relevant.
+"""
+
+import os
+import struct
+import pickle
+
+from handlers.feed.files import write_atomically, flush
+
+HEADER = struct.Struct('>I')
+
+
+class Journal():
+    """The journal file at path. count is the number of records in it."""
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def replay(self):
+        """Return the list of records, oldest first. A partly written last
+        record is cut off.
+        """
+        records = []
+        try:
+            file = open(self.path, 'rb')
+        except IOError:
+            self.count = 0
+            return records
+        with file:
+            data = file.read()
+        offset = 0
+        while offset + HEADER.size <= len(data):
+            length, = HEADER.unpack_from(data, offset)
+            end = offset + HEADER.size + length
+            if end > len(data):
+                break
+            try:
+                records.append(pickle.loads(data[offset + HEADER.size:end]))
+            except Exception:
+                break
+            offset = end
+        if offset < len(data):
+            with open(self.path, 'r+b') as file:
+                file.truncate(offset)
+        self.count = len(records)
+        return records
+
+    def append(self, record):
+        """Append the record to the journal."""
+        with open(self.path, 'ab') as file:
+            file.write(_encode(record))
+            flush(file)
+        self.count += 1
+
+    def rewrite(self, records):
+        """Replace the journal by one containing the given records."""
+        write_atomically(self.path, lambda file:
+            file.write(''.join(_encode(record) for record in records)))
+        self.count = len(records)
+
+
+def _encode(record):
+    data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+    return HEADER.pack(len(data)) + data
@@ -0,0 +1,149 @@
+"""A message store shared by all feed handlers.
+
+A message that appears in several feeds (e.g., in the feed of all messages
+and in the feed of its project) is kept and persisted only once. Feeds refer
+to messages by guid and the store counts these references. When no loaded
+feed refers to a message any more, it is removed from memory. Its file is
+kept, as feeds that are not loaded may still refer to it, and deleted by
+collect() once no feed does.
+
+The store also keeps the serialized feed entry of each message, as it is
+the same in all feeds.
+"""
+
+import os
+import hashlib
+import pickle
+import threading
+
+from handlers.feed.files import write_atomically
+
+
+class MessageStore():
+    """Reference counted messages, each persisted as a pickle file in the
+    store's directory.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, message):
+        """Add a reference to the message. A new message is persisted."""
+        with self._lock:
+            entry = self._entries.get(message.guid)
+            if entry is None:
+                self._save(message)
+                entry = self._entries[message.guid] = _Entry(message)
+            entry.references += 1
+
+    def put(self, message):
+        """Persist the message, if it is not stored yet, without adding
+        a reference to it.
+        """
+        with self._lock:
+            if message.guid not in self._entries \
+                    and not os.path.exists(self._path(message.guid)):
+                self._save(message)
+
+    def acquire(self, guid):
+        """Add a reference to the stored message with the guid and return
+        it, loading it from disk if necessary. Return None if there is no
+        such message.
+        """
+        with self._lock:
+            entry = self._entries.get(guid)
+            if entry is None:
+                message = self._load(guid)
+                if message is None:
+                    return None
+                entry = self._entries[guid] = _Entry(message)
+            entry.references += 1
+            return entry.message
+
+    def release(self, guid):
+        """Remove a reference to the message with the guid. Unreferenced
+        messages are removed from memory.
+        """
+        with self._lock:
+            entry = self._entries.get(guid)
+            if entry is None:
+                return
+            entry.references -= 1
+            if entry.references <= 0:
+                del self._entries[guid]
+
+    def collect(self, guids):
+        """Delete the persisted messages that are neither referenced nor
+        among the given guids. Return the number of deleted messages.
+        """
+        keep = set(self._filename(guid) for guid in guids)
+        deleted = 0
+        with self._lock:
+            keep.update(self._filename(guid) for guid in self._entries)
+            try:
+                filenames = os.listdir(self.directory)
+            except OSError:
+                return deleted
+            for filename in filenames:
+                if filename.endswith('.pkl') and not filename.startswith('.') \
+                        and filename not in keep:
+                    self._delete(filename)
+                    deleted += 1
+        return deleted
+
+    def get(self, guid):
+        """Return the referenced message with the guid."""
+        return self._entries[guid].message
+
+    def fragment(self, guid, create):
+        """Return the serialized feed entry of the message with the guid,
+        create(message) is called if it was not serialized before.
+        """
+        entry = self._entries[guid]
+        if entry.fragment is None:
+            entry.fragment = create(entry.message)
+        return entry.fragment
+
+    def _save(self, message):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        write_atomically(self._path(message.guid),
+            lambda file: pickle.dump(message, file))
+
+    def _load(self, guid):
+        try:
+            file = open(self._path(guid), 'rb')
+        except IOError:
+            return None
+        try:
+            return pickle.load(file)
+        finally:
+            file.close()
+
+    def _delete(self, filename):
+        try:
+            os.remove(os.path.join(self.directory, filename))
+        except OSError:
+            pass
+
+    def _path(self, guid):
+        return os.path.join(self.directory, self._filename(guid))
+
+    def _filename(self, guid):
+        if isinstance(guid, unicode):
+            guid = guid.encode('utf-8')
+        return hashlib.sha1(guid).hexdigest() + '.pkl'
+
+
+class _Entry():
+    """A stored message, its serialized feed entry and reference count."""
+
+    def __init__(self, message):
+        self.message = message
+        self.fragment = None
+        self.references = 0
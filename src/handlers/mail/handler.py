@@ -1,12 +1,20 @@
 """A handler that sends mails."""
 
-import smtplib
 import os.path
+import time
+import smtplib
+import threading
+from collections import OrderedDict
 from ConfigParser import RawConfigParser
 
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
+from handlers.mail.smtp import SMTPPool
+from handlers.coalesce import FlushTimer
+from registry import any_of
+from outbox import OUTBOX, PermanentFailure
+
 # load config
 CFG_PATH = os.path.join(
     os.path.dirname(__file__), '..', '..', '..', 'notify.cfg')
@@ -15,33 +23,179 @@ CONFIG.read(CFG_PATH)
 SENDER_MAIL = CONFIG.get('mail', 'sender')
 SMPT_SERVER = CONFIG.get('mail', 'smtp_server')
 
+# SMTP sessions are kept open and shared by all mail handlers
+POOL_SIZE = 2
+if CONFIG.has_option('mail', 'pool_size'):
+    POOL_SIZE = CONFIG.getint('mail', 'pool_size')
+POOL_IDLE_TIMEOUT = 60
+if CONFIG.has_option('mail', 'pool_idle_timeout'):
+    POOL_IDLE_TIMEOUT = CONFIG.getfloat('mail', 'pool_idle_timeout')
+SMTP_TIMEOUT = 30
+if CONFIG.has_option('mail', 'timeout'):
+    SMTP_TIMEOUT = CONFIG.getfloat('mail', 'timeout')
+STARTTLS = False
+if CONFIG.has_option('mail', 'starttls'):
+    STARTTLS = CONFIG.getboolean('mail', 'starttls')
+SMTP_USERNAME = None
+SMTP_PASSWORD = None
+if CONFIG.has_option('mail', 'username'):
+    SMTP_USERNAME = CONFIG.get('mail', 'username')
+    SMTP_PASSWORD = CONFIG.get('mail', 'password')
+
+# In digest mode (digest_window > 0), the messages for a recipient are
+# collected for digest_window seconds, or until there are digest_max, and
+# sent as a single mail.
+DIGEST_WINDOW = 0
+if CONFIG.has_option('mail', 'digest_window'):
+    DIGEST_WINDOW = CONFIG.getfloat('mail', 'digest_window')
+DIGEST_MAX = 20
+if CONFIG.has_option('mail', 'digest_max'):
+    DIGEST_MAX = CONFIG.getint('mail', 'digest_max')
+
+POOL = SMTPPool(SMPT_SERVER, POOL_SIZE, POOL_IDLE_TIMEOUT, SMTP_TIMEOUT,
+    STARTTLS, SMTP_USERNAME, SMTP_PASSWORD)
+
 
 class MailHandler():
     """Handler is initialized with two functions, the first being a
     predicate to decide whether to send a mail, the second returning
-    a list of recipient mail addresses."""
+    a list of recipient mail addresses. More such rules can be added,
+    then a message matching several rules is sent once to the union of
+    their recipients. In digest mode, each recipient gets one mail with
+    the messages of digest_window seconds (at most digest_max). Mails are
+    sent through the outbox."""
+
+    executor = 'mail'
     
-    def __init__(self, interested_in, getrecipients):
-        self.interested_in = interested_in
-        self.getrecipients = getrecipients
+    def __init__(self, interested_in, getrecipients, pool=None,
+            digest_window=None, digest_max=None, outbox=None):
+        self.rules = []
+        self.pool = pool if pool is not None else POOL
+        self.outbox = outbox if outbox is not None else OUTBOX
+        self.digest_window = digest_window
+        if digest_window is None:
+            self.digest_window = DIGEST_WINDOW
+        self.digest_max = digest_max or DIGEST_MAX
+        self._digests = {}
+        self._lock = threading.Lock()
+        self._timer = FlushTimer(self.flush)
+        self.add_rule(interested_in, getrecipients)
+
+    def add_rule(self, interested_in, getrecipients):
+        """Also send mails to getrecipients(message) for the messages
+        matching interested_in. Rules have to be added before the handler
+        is registered.
+        """
+        self.rules.append((interested_in, getrecipients))
+        self.interested_in = any_of([rule for rule, _ in self.rules])
         
+    def register_channels(self):
+        """Deliver the mails of the outbox with this handler's pool, called
+        when the handler is installed.
+        """
+        self.outbox.register('mail', self._deliver)
+
     def handle(self, message):
-        """Send multipart mail."""
-        if (not self.interested_in(message)):
-            return None
-        recipients = self.getrecipients(message)
+        """Send multipart mail, or add the message to the digests."""
+        recipients = set()
+        for interested_in, getrecipients in self.rules:
+            if interested_in(message):
+                recipients.update(getrecipients(message))
         if len(recipients) == 0:
             return None
+        if self.digest_window <= 0:
+            self._send(sorted(recipients), [message])
+            return
+        with self._lock:
+            now = time.time()
+            full = []
+            for recipient in recipients:
+                since, messages = self._digests.setdefault(recipient,
+                    (now, []))
+                messages.append(message)
+                if len(messages) >= self.digest_max:
+                    full.append(recipient)
+            digests = self._take(full)
+            self._schedule(now)
+        self._send_digests(digests)
+
+    def flush(self, force=False):
+        """Send the digests whose window has passed, or all if force."""
+        with self._lock:
+            self._timer.cancel()
+            now = time.time()
+            digests = self._take([recipient
+                for recipient, (since, _) in self._digests.items()
+                if force or now - since >= self.digest_window])
+            self._schedule(now)
+        self._send_digests(digests)
+
+    def close(self):
+        """Send pending digests and quit the idle SMTP sessions, called on
+        shutdown.
+        """
+        self.flush(force=True)
+        self.pool.close()
+
+    # remove and return the digests of the recipients
+    def _take(self, recipients):
+        return [(recipient, self._digests.pop(recipient)[1])
+            for recipient in recipients]
+
+    # flush when the oldest digest is due
+    def _schedule(self, now):
+        if self._timer.scheduled or not self._digests:
+            return
+        since = min(since for since, _ in self._digests.values())
+        self._timer.schedule(max(since + self.digest_window - now, 0))
+
+    # recipients with the same messages get the same mail
+    def _send_digests(self, digests):
+        groups = OrderedDict()
+        for recipient, messages in digests:
+            key = tuple(id(message) for message in messages)
+            groups.setdefault(key, (messages, []))[1].append(recipient)
+        for messages, recipients in groups.values():
+            self._send(sorted(recipients), messages)
+
+    def _send(self, recipients, messages):
         msg = MIMEMultipart('alternative')
-        msg['Subject'] = message.title
+        if len(messages) == 1:
+            msg['Subject'] = messages[0].title
+        else:
+            msg['Subject'] = u'%d changes, latest: %s' % (len(messages),
+                messages[-1].title)
         msg['From'] = SENDER_MAIL
-        content = message.content_plain.encode('utf-8')
+        content = u'\n\n'.join(message.content_plain
+            for message in messages).encode('utf-8')
         part1 = MIMEText(content, 'plain', 'utf-8')
-        content = message.content.encode('utf-8')
+        content = u'<html><body>' + u'<hr/>'.join(_html_body(message.content)
+            for message in messages) + u'</body></html>'
+        content = content.encode('utf-8')
         part2 = MIMEText(content, 'html', 'utf-8')
         msg.attach(part1)
         msg.attach(part2)
-        smtp = smtplib.SMTP(SMPT_SERVER)
-        smtp.sendmail(SENDER_MAIL, recipients, msg.as_string())
-        smtp.close()
-        
\ No newline at end of file
+        self.outbox.put('mail', (SENDER_MAIL, recipients, msg.as_string()))
+
+    # called by the outbox, mails rejected by the server are not retried
+    def _deliver(self, mail):
+        sender, recipients, data = mail
+        try:
+            self.pool.sendmail(sender, recipients, data)
+        except smtplib.SMTPRecipientsRefused as err:
+            raise PermanentFailure(str(err))
+        except smtplib.SMTPResponseException as err:
+            if err.smtp_code >= 500:
+                raise PermanentFailure(str(err))
+            raise
+
+
+def _html_body(content):
+    """Return the html content of a message without the enclosing html and
+    body elements, so that a digest is a single html document.
+    """
+    if content.startswith(u'<html><body>'):
+        content = content[len(u'<html><body>'):]
+    if content.endswith(u'</body></html>'):
+        content = content[:-len(u'</body></html>')]
+    return content
@@ -0,0 +1,131 @@
+"""A pool of keep-alive SMTP sessions shared by the mail handlers, so that
+sending a mail is a single transaction instead of connect, EHLO, (STARTTLS,
+login,) mail and QUIT.
+
+Before an idle session is reused, it is checked with a NOOP. A mail that
+fails because a reused session was disconnected is resent once on a new
+session.
+"""
+
+import time
+import socket
+import smtplib
+import threading
+
+
+class SMTPPool():
+    """A bounded pool of SMTP sessions to host (which may include the port,
+    e.g., 'mail.example.com:587'). Sessions idle for longer than
+    idle_timeout seconds are closed instead of reused. If starttls is set,
+    sessions are encrypted, if username is set, they are authenticated.
+    """
+
+    def __init__(self, host, size=2, idle_timeout=60, timeout=30,
+            starttls=False, username=None, password=None,
+            smtp_class=smtplib.SMTP):
+        self.host = host
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.starttls = starttls
+        self.username = username
+        self.password = password
+        self.smtp_class = smtp_class
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def sendmail(self, sender, recipients, message):
+        """Send the message (a string) and return the refused recipients
+        like smtplib.SMTP.sendmail. Raises smtplib.SMTPException or
+        socket.error if the mail cannot be sent.
+        """
+        self._slots.acquire()
+        try:
+            smtp, reused = self._checkout()
+            try:
+                refused = smtp.sendmail(sender, recipients, message)
+            except (smtplib.SMTPServerDisconnected, socket.error):
+                _close(smtp)
+                if not reused:
+                    raise
+                smtp = self._connect()
+                try:
+                    refused = smtp.sendmail(sender, recipients, message)
+                except (smtplib.SMTPServerDisconnected, socket.error):
+                    _close(smtp)
+                    raise
+                except smtplib.SMTPException:
+                    self._checkin(smtp)
+                    raise
+            except smtplib.SMTPException:
+                # the session is still usable, e.g., recipients were refused
+                self._checkin(smtp)
+                raise
+            self._checkin(smtp)
+            return refused
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """Quit all idle sessions."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for smtp, _ in idle:
+            _quit(smtp)
+
+    def _checkout(self):
+        """Return a tuple (session, reused), preferring the most recently
+        used idle session that has not timed out and answers a NOOP.
+        """
+        now = time.time()
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                smtp, last_used = self._idle.pop()
+            if now - last_used >= self.idle_timeout:
+                _quit(smtp)
+            elif _is_alive(smtp):
+                return smtp, True
+            else:
+                _close(smtp)
+        return self._connect(), False
+
+    def _checkin(self, smtp):
+        if smtp.sock is None:
+            return
+        with self._lock:
+            self._idle.append((smtp, time.time()))
+
+    def _connect(self):
+        smtp = self.smtp_class(self.host, timeout=self.timeout)
+        try:
+            if self.starttls:
+                smtp.ehlo()
+                smtp.starttls()
+                smtp.ehlo()
+            if self.username:
+                smtp.login(self.username, self.password)
+        except:
+            _close(smtp)
+            raise
+        return smtp
+
+
+def _is_alive(smtp):
+    try:
+        return smtp.noop()[0] == 250
+    except (smtplib.SMTPException, socket.error):
+        return False
+
+def _quit(smtp):
+    try:
+        smtp.quit()
+    except (smtplib.SMTPException, socket.error):
+        _close(smtp)
+
+def _close(smtp):
+    try:
+        smtp.close()
+    except socket.error:
+        pass
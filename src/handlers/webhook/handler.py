@@ -1,13 +1,23 @@
 """A Webhook handler that notifies another server about events by
 sending HTTP requests to some URL.
+
+There can be many webhook handlers (endpoints), each with its own rule and
+payload fields. The data of a message is serialized once per set of fields
+and shared by the endpoints. Each named endpoint has its own outbox channel,
+so the requests to the endpoints are sent in parallel, within the endpoint's
+concurrency and rate limits.
 """
 
 import os
-import urllib
-import httplib
 import json
+import threading
+from collections import OrderedDict
 from ConfigParser import RawConfigParser
 
+from outbox import OUTBOX, PermanentFailure
+from httppool import get_pool
+from handlers.coalesce import FlushTimer
+
 
 CFG_PATH = os.path.join(
     os.path.dirname(__file__), '..', '..', '..', 'notify.cfg')
@@ -15,30 +25,187 @@ CONFIG = RawConfigParser()
 CONFIG.read(CFG_PATH)
 HOOK_HOST = CONFIG.get('webhook', 'host')
 HOOK_PATH = CONFIG.get('webhook', 'path')
+HEADERS = {"Content-type": "application/json"}
+
+# the message attributes that can be sent
+FIELDS = ('project_id', 'story_id', 'text', 'status', 'tags', 'creator',
+    'creator_mail')
+
+# Requests are sent on keep-alive connections, pooled per host. A host can
+# be prefixed with https:// (or http://, the default).
+POOL_SIZE = 2
+if CONFIG.has_option('webhook', 'pool_size'):
+    POOL_SIZE = CONFIG.getint('webhook', 'pool_size')
+POOL_IDLE_TIMEOUT = 60
+if CONFIG.has_option('webhook', 'pool_idle_timeout'):
+    POOL_IDLE_TIMEOUT = CONFIG.getfloat('webhook', 'pool_idle_timeout')
+REQUEST_TIMEOUT = 10
+if CONFIG.has_option('webhook', 'timeout'):
+    REQUEST_TIMEOUT = CONFIG.getfloat('webhook', 'timeout')
+
+# In batch mode (batch_size > 1), the data of up to batch_size messages is
+# sent as a JSON array in one request, at the latest batch_interval seconds
+# after the first of them.
+BATCH_SIZE = 1
+if CONFIG.has_option('webhook', 'batch_size'):
+    BATCH_SIZE = CONFIG.getint('webhook', 'batch_size')
+BATCH_INTERVAL = 5.0
+if CONFIG.has_option('webhook', 'batch_interval'):
+    BATCH_INTERVAL = CONFIG.getfloat('webhook', 'batch_interval')
 
 
 class WebhookHandler():
+    """Sends the message's data as JSON in a PUT request, through the
+    outbox. Requests that fail with a server error are retried. In batch
+    mode, a request contains an array with the data of several messages.
+    """
+
+    executor = 'webhook'
     
-    def __init__(self, interested_in, host=HOOK_HOST, path=HOOK_PATH):
+    def __init__(self, interested_in, host=HOOK_HOST, path=HOOK_PATH,
+            outbox=None, batch_size=None, batch_interval=None, name=None,
+            fields=FIELDS, concurrency=0, rate_limit=0):
         self.interested_in = interested_in
         self.host = host
         self.path = path
+        self.fields = tuple(fields)
+        self.channel = 'webhook'
+        if name is not None:
+            self.channel += ':' + name
+        self.outbox = outbox if outbox is not None else OUTBOX
+        self.concurrency = concurrency
+        self.rate_limit = rate_limit
+        self.batch_size = batch_size or BATCH_SIZE
+        self.batch_interval = batch_interval or BATCH_INTERVAL
+        self._batch = []
+        self._lock = threading.Lock()
+        self._timer = FlushTimer(self.flush)
+
+    def register_channels(self):
+        """Deliver the requests of the channel within the endpoint's
+        limits, called when the handler is installed.
+        """
+        self.outbox.register(self.channel, _deliver, self.concurrency,
+            self.rate_limit)
+
+    @property
+    def stats(self):
+        """The status codes and latency of the requests to the host."""
+        return _pool(self.host).stats
         
     def handle(self, message):
-        if self.interested_in(message):
-            self._send_request(message)
-        
-    def _send_request(self, message):
-        data = {
-            'project_id':message.project_id,
-            'story_id':message.story_id,
-            'text':message.text,
-            'status':message.status,
-            'tags':message.tags,
-            'creator':message.creator,
-            'creator_mail':message.creator_mail
-        }
-        header = {"Content-type": "application/json"}
-        params = urllib.urlencode(data)
-        conn = httplib.HTTPConnection(self.host, timeout=10)
-        conn.request("PUT", self.path, json.dumps(data), header)
\ No newline at end of file
+        if not self.interested_in(message):
+            return
+        if self.batch_size <= 1:
+            self._send_request(PAYLOADS.body(message, self.fields))
+            return
+        with self._lock:
+            self._batch.append(PAYLOADS.get(message, self.fields))
+            if len(self._batch) >= self.batch_size:
+                self._flush()
+            else:
+                self._timer.schedule(self.batch_interval)
+
+    def flush(self):
+        """Send the batched data."""
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        """Send the batched data, called on shutdown."""
+        self.flush()
+
+    # send the batch and cancel the scheduled flush
+    def _flush(self):
+        self._timer.cancel()
+        if self._batch:
+            self._send_request(json.dumps(self._batch))
+            self._batch = []
+
+    # a batch is delivered (and retried) as a whole
+    def _send_request(self, body):
+        self.outbox.put(self.channel, (self.host, self.path, body))
+
+
+class Payloads():
+    """The data and JSON serialization of the most recent messages by set
+    of fields, so that endpoints with the same fields share them.
+    """
+
+    def __init__(self, size=16):
+        self.size = size
+        self._recent = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, message, fields):
+        """Return a dict with the message's fields."""
+        return self._payload(message, fields)[0]
+
+    def body(self, message, fields):
+        """Return the JSON serialization of the message's fields."""
+        payload = self._payload(message, fields)
+        if payload[1] is None:
+            # endpoints serializing at the same time get equal bodies
+            payload[1] = json.dumps(payload[0])
+        return payload[1]
+
+    # return [data, body or None], serializing is left to body(). Reading
+    # the fields may load the story, hence it is done without the lock
+    # (the message loads it once).
+    def _payload(self, message, fields):
+        with self._lock:
+            payload = self._payloads(message).get(fields)
+        if payload is not None:
+            return payload
+        payload = [dict((field, getattr(message, field))
+            for field in fields), None]
+        with self._lock:
+            return self._payloads(message).setdefault(fields, payload)
+
+    # return the cached payloads of the message by fields
+    def _payloads(self, message):
+        # the message is kept, hence its id is not reused meanwhile
+        cached, payloads = self._recent.get(id(message), (None, None))
+        if cached is not message:
+            payloads = {}
+            self._recent[id(message)] = (message, payloads)
+            if len(self._recent) > self.size:
+                self._recent.popitem(last=False)
+        return payloads
+
+PAYLOADS = Payloads()
+
+
+def register_webhooks(outbox=None):
+    """Register the delivery of the plain webhook channel, and of the
+    channels of named endpoints that have pending requests, so that the
+    requests of endpoints that are not configured anymore are sent, too.
+    Called before the handlers are installed, which register their
+    channels with their limits.
+    """
+    outbox = outbox if outbox is not None else OUTBOX
+    for channel in ['webhook'] + outbox.pending_channels():
+        if channel == 'webhook' or channel.startswith('webhook:'):
+            outbox.register(channel, _deliver)
+
+
+# called by the outbox, requests rejected by the receiver are not retried
+def _deliver(request):
+    host, path, body = request
+    status, _ = _pool(host).request("PUT", path, body, HEADERS)
+    if status >= 500 or status in (408, 429):
+        raise WebhookException('Webhook %s%s failed with status %d'
+            % (host, path, status))
+    if status >= 400:
+        raise PermanentFailure('Webhook %s%s rejected with status %d'
+            % (host, path, status))
+
+
+def _pool(host):
+    return get_pool(host, size=POOL_SIZE, idle_timeout=POOL_IDLE_TIMEOUT,
+        timeout=REQUEST_TIMEOUT)
+
+
+class WebhookException(Exception):
+    """Raised when a request fails temporarily, it is retried."""
+    pass
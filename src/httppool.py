@@ -0,0 +1,183 @@
+"""Pools of persistent (keep-alive) HTTP and HTTPS connections, shared by
+the API functions and the webhook handlers.
+
+Responses are always read completely, so that connections can be reused,
+and each pool records the status codes and latency of its requests.
+"""
+
+import time
+import errno
+import socket
+import httplib
+import threading
+
+
+class ConnectionPool():
+    """A bounded pool of persistent (keep-alive) HTTP connections to a
+    single host. Connections idle for longer than idle_timeout seconds are
+    closed instead of reused. A request that fails on a reused connection
+    because the server closed it in the meantime (i.e., before sending a
+    response) is retried once on a fresh connection. Requests that time
+    out are not retried, the server may have received them.
+    """
+
+    def __init__(self, host, size=4, idle_timeout=60, timeout=30,
+            connection_class=httplib.HTTPConnection):
+        self.host = host
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.connection_class = connection_class
+        self.stats = PoolStats()
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def request(self, method, path, body=None, headers=None):
+        """Send the request and return a tuple (status, response body).
+        Raises PoolException if the host cannot be reached.
+        """
+        self._slots.acquire()
+        start = time.time()
+        try:
+            conn, reused = self._checkout()
+            try:
+                result = self._send(conn, method, path, body, headers)
+            except (socket.error, httplib.HTTPException) as err:
+                conn.close()
+                if not reused or not _is_stale(err):
+                    self.stats.failed()
+                    raise PoolException('Failed to connect to '
+                        + self.host + ': ' + str(err))
+                conn, reused = self._connect(), False
+                try:
+                    result = self._send(conn, method, path, body, headers)
+                except (socket.error, httplib.HTTPException) as err:
+                    conn.close()
+                    self.stats.failed()
+                    raise PoolException('Failed to connect to '
+                        + self.host + ': ' + str(err))
+            self._checkin(conn)
+            self.stats.record(result[0], time.time() - start)
+            return result
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """Close all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            conn.close()
+
+    def _send(self, conn, method, path, body, headers):
+        conn.request(method, path, body, headers or {})
+        response = conn.getresponse()
+        # the response has to be read completely to reuse the connection
+        try:
+            data = response.read()
+        except socket.error as err:
+            # the request was received, it must not be retried
+            raise httplib.HTTPException('Failed to read response: '
+                + str(err))
+        if response.will_close:
+            conn.close()
+        return response.status, data
+
+    def _checkout(self):
+        """Return a tuple (connection, reused), preferring the most
+        recently used idle connection that has not timed out yet.
+        """
+        now = time.time()
+        expired = []
+        conn = None
+        with self._lock:
+            while self._idle:
+                candidate, last_used = self._idle.pop()
+                if now - last_used < self.idle_timeout:
+                    conn = candidate
+                    break
+                expired.append(candidate)
+        for each in expired:
+            each.close()
+        if conn is None:
+            return self._connect(), False
+        return conn, True
+
+    def _checkin(self, conn):
+        if conn.sock is None:
+            return
+        with self._lock:
+            self._idle.append((conn, time.time()))
+
+    def _connect(self):
+        return self.connection_class(self.host, timeout=self.timeout)
+
+
+class PoolStats():
+    """Counts the requests by response status (None for failed requests)
+    and sums up their latency in seconds.
+    """
+
+    def __init__(self):
+        self.statuses = {}
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def requests(self):
+        return sum(self.statuses.values())
+
+    @property
+    def mean_latency(self):
+        """The mean latency of the requests that got a response."""
+        answered = self.requests - self.statuses.get(None, 0)
+        return answered and self.total_latency / answered
+
+    def record(self, status, latency):
+        with self._lock:
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+
+    def failed(self):
+        with self._lock:
+            self.statuses[None] = self.statuses.get(None, 0) + 1
+
+
+def _is_stale(err):
+    """Return true if the error means that the server had closed the
+    connection before the request was sent.
+    """
+    if isinstance(err, httplib.BadStatusLine):
+        return True
+    return isinstance(err, socket.error) \
+        and not isinstance(err, socket.timeout) \
+        and err.errno in (errno.ECONNRESET, errno.EPIPE)
+
+def get_pool(url, **options):
+    """Return the shared pool for url, which is a host optionally prefixed
+    with http:// or https:// (e.g., 'https://example.com:8443'). Options
+    are passed to the pool when it is created.
+    """
+    with _POOLS_LOCK:
+        pool = _POOLS.get(url)
+        if pool is None:
+            connection_class = httplib.HTTPConnection
+            host = url
+            if url.startswith('https://'):
+                connection_class = httplib.HTTPSConnection
+                host = url[len('https://'):]
+            elif url.startswith('http://'):
+                host = url[len('http://'):]
+            pool = _POOLS[url] = ConnectionPool(host.rstrip('/'),
+                connection_class=connection_class, **options)
+        return pool
+
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+
+class PoolException(Exception):
+    """Raised when a host cannot be reached."""
+    pass
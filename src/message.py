@@ -1,6 +1,12 @@
 """Agilezen message with additional information obtained through the API.
 Creates plain text and HTML representations of a message.
 
+A message is created in two phases: the header (title, project and story,
+link, causer) is parsed from the XMPP message right away, whereas the story
+data (text, status, creator, content, etc.) is loaded from the API the first
+time one of these attributes is read. Hence, messages no rule is interested
+in never touch the API.
+
 Note, regexes make assumptions about the text structure of AgileZen messages!
 Future changes have to be reflected here (at least until AgileZen supports
 WebHooks...).
@@ -12,6 +18,7 @@ named 'Members' (this is the default).
 import time
 import re
 import StringIO
+import threading
 from datetime import datetime
 
 from sleekxmpp.xmlstream.tostring import tostring
@@ -19,21 +26,80 @@ from markdown2 import markdown
 
 import api
 
-# Regular expression strings to parse out data from the XMPP message 
-PROJECT_STORY_RE = 'https://agilezen.com/project/(\d*)/story/(\d*)'
-ALT_PROJECT_STORY_RE = '\[(\w*)\].*\(\#(\d*)\)'
-NEW_STORY_RE = '\) was created by '
-MARKED_BLOCKED_RE = '\) was blocked by '
-MARKED_DEPLOYED_RE = '\) was moved from .*? to Deployed'
-MOVED_TO_READY_RE = 'was moved from .*? to Ready'
-CAUSER_RE = '\sby\s([A-Z]\w+\s[A-Z]\w+)'
+# Regular expressions to parse out data from the XMPP message 
+PROJECT_STORY_RE = re.compile(
+    'https://agilezen.com/project/(\d*)/story/(\d*)')
+ALT_PROJECT_STORY_RE = re.compile('\[(\w*)\].*\(\#(\d*)\)', re.DOTALL)
+CAUSER_RE = re.compile('\sby\s([A-Z]\w+\s[A-Z]\w+)', re.UNICODE)
+NEWLINES_RE = re.compile('([\n\r]+)')
+
+# Event types, a message's events attribute is a bitset of these
+NEW = 1
+MOVED_TO_READY = 2
+MARKED_BLOCKED = 4
+MARKED_DEPLOYED = 8
+EVENT_TYPES = {
+    'new': NEW,
+    'moved_to_ready': MOVED_TO_READY,
+    'marked_blocked': MARKED_BLOCKED,
+    'marked_deployed': MARKED_DEPLOYED }
+
+# The title is classified in a single pass, each alternative is named after
+# its event type.
+EVENT_RE = re.compile('|'.join([
+    '(?P<new>\) was created by )',
+    '(?P<marked_blocked>\) was blocked by )',
+    '(?P<marked_deployed>\) was moved from .*? to Deployed)',
+    '(?P<moved_to_ready>was moved from .*? to Ready)' ]))
+
+
+class _lazy_attribute(object):
+    """Decorator turning a method without arguments into an attribute
+    that is computed on first access. The result is stored in the instance,
+    hence the method is called at most once.
+    """
+
+    def __init__(self, method):
+        self.method = method
+        self.__doc__ = method.__doc__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = self.method(instance)
+        instance.__dict__[self.method.__name__] = value
+        return value
+
+
+class _story_attribute(object):
+    """An attribute whose value is taken from the story, which is loaded
+    from the API on first access.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        instance._load_additional_data()
+        return instance.__dict__[self.name]
 
 
 class AZMessage():
     """Agilezen message with additional information obtained through the API.
-    Creates plain text and HTML representations of a message.
+    Creates plain text and HTML representations of a message. These are
+    rendered only when a handler reads content or content_plain.
     """
 
+    text = _story_attribute('text')
+    tags = _story_attribute('tags')
+    status = _story_attribute('status')
+    color = _story_attribute('color')
+    creator = _story_attribute('creator')
+    creator_mail = _story_attribute('creator_mail')
+    _story = _story_attribute('_story')
+
     @staticmethod
     def is_agilezen_xmpp_message(xmpp_msg):
         """Check whether xmpp message is of interesest.""" 
@@ -42,19 +108,13 @@ class AZMessage():
         return chat_message and from_agilezen
         
     def __init__(self, xmpp_msg):
-        self.title = re.sub('([\n\r]+)', '. ', xmpp_msg['body'])
+        self.title = NEWLINES_RE.sub('. ', xmpp_msg['body'])
+        self.events = classify(self.title)
         self.pubdate = datetime.utcnow()
         self.project_id = None
         self.story_id = None
         self.categories = []
-        self.text = None
-        self.tags = None
-        self.status = None
-        self.color = None
-        self.creator = None
-        self.creator_mail = None
-        self.content = None
-        self.content_plain = None
+        self._lock = threading.Lock()
 
         source = tostring(xmpp_msg['html']['body'])
         self._load_project_and_story(source)
@@ -62,10 +122,9 @@ class AZMessage():
             + '/project/' + str(self.project_id) \
             + '/story/' + str(self.story_id)
         self.guid = self.link + '#' + xmpp_msg['id']
-        match = re.search(CAUSER_RE, source, re.UNICODE)
+        match = CAUSER_RE.search(source)
         if match:
             self.causer = match.group(1)
-        self._load_additional_data()
 
     def _load_project_and_story(self, source):
         """Try to extract and set the project and story IDs.
@@ -74,12 +133,12 @@ class AZMessage():
         In this case, resort to parsing project name and looking up its ID
         via the API.
         """
-        match = re.search(PROJECT_STORY_RE, source)
+        match = PROJECT_STORY_RE.search(source)
         if match:
             self.project_id = int(match.group(1))
             self.story_id = int(match.group(2))
         else:
-            match = re.search(ALT_PROJECT_STORY_RE, source, flags=re.DOTALL)
+            match = ALT_PROJECT_STORY_RE.search(source)
             if match:
                 self.project_id = api.lookup_project_id(match.group(1))
                 self.story_id = int(match.group(2))
@@ -88,21 +147,56 @@ class AZMessage():
                     'Could not parse project/story number from: ' + source)
           
     def _load_additional_data(self):
-        """Create html and text representations and load status,
-        creator, and creator_mail from the API."""
-        story = api.get_story(self.project_id, self.story_id)
-        self.content = self._create_html_content_from(story)
-        self.content_plain = self._create_plain_content_from(story)
-        try:
-            self.text = story['text']
-            self.status = story['status']
-            self.color = story['color']
-            self.tags = story['tags']
-            self.creator = story['creator']['name']
-            self.creator_mail = story['creator']['email']
-        except KeyError as err:
-            raise MessageCreationException(
-                'Failed to read data from API: ' + str(err))
+        """Load the story and its status, creator, and creator_mail from
+        the API, unless this was done before."""
+        with self._lock:
+            if '_story' in self.__dict__:
+                return
+            story = api.get_story(self.project_id, self.story_id)
+            try:
+                self.text = story['text']
+                self.status = story['status']
+                self.color = story['color']
+                self.tags = story['tags']
+                self.creator = story['creator']['name']
+                self.creator_mail = story['creator']['email']
+            except KeyError as err:
+                raise MessageCreationException(
+                    'Failed to read data from API: ' + str(err))
+            self._story = story
+
+    @_lazy_attribute
+    def content(self):
+        """The html representation of this story."""
+        return self._create_html_content_from(self._story)
+
+    @_lazy_attribute
+    def content_plain(self):
+        """The plain text representation of this story."""
+        return self._create_plain_content_from(self._story)
+
+    def __getstate__(self):
+        """Pickle the rendered content instead of the story data. The story
+        is only loaded if the content was not rendered yet.
+        """
+        if 'content' not in self.__dict__ \
+                or 'content_plain' not in self.__dict__:
+            self._load_additional_data()
+        state = self.__dict__.copy()
+        state['content'] = self.content
+        state['content_plain'] = self.content_plain
+        state.pop('_story', None)
+        state.pop('_lock', None)
+        return state
+
+    def __setstate__(self, state):
+        """Restore a pickled message, which may have been pickled by an
+        earlier version (without events).
+        """
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        if 'events' not in state:
+            self.events = classify(self.title)
 
     def _create_html_content_from(self, story):
         """Return an html representation of this story."""
@@ -175,24 +269,24 @@ class AZMessage():
     def is_new(self):
         """Returns true if the message was triggered when creating a story.
         """
-        return re.search(NEW_STORY_RE, self.title) is not None
+        return bool(self.events & NEW)
     
     def is_moved_to_ready(self):
         """Returns true if the current story is moved into the ready queue."""
-        moved_ready = re.search(MOVED_TO_READY_RE, self.title) is not None
-        new_and_started = self.is_new() and self.status == 'started'
-        return moved_ready or new_and_started
+        if self.events & MOVED_TO_READY:
+            return True
+        return bool(self.events & NEW) and self.status == 'started'
         
     def is_marked_blocked(self):
         """Returns true if the message was triggered when blocking the story.
         """    
-        return re.search(MARKED_BLOCKED_RE, self.title) is not None
+        return bool(self.events & MARKED_BLOCKED)
     
     def is_marked_deployed(self):
         """Returns true if the message was triggered when moving story
         to deployed.
         """
-        return re.search(MARKED_DEPLOYED_RE, self.title) is not None
+        return bool(self.events & MARKED_DEPLOYED)
 
     def __str__(self):
         return "<AZMessage '" + self.title + "' [" + self.guid + "]>"
@@ -203,6 +297,13 @@ class MessageCreationException(Exception):
     pass
 
 
+def classify(title):
+    """Return the bitset of event types of the message title."""
+    events = 0
+    for match in EVENT_RE.finditer(title):
+        events |= EVENT_TYPES[match.lastgroup]
+    return events
+
 def _convert_gmt(string):
     """Convert the argument, a timestamp in GMT, to a timestamp
     string in the local time zone. Format as %d.%m.%Y %H:%M."""
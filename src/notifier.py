@@ -18,7 +18,10 @@ from sleekxmpp.stanza.htmlim import HTMLIM
 from sleekxmpp.xmlstream import register_stanza_plugin
 
 from message import AZMessage, MessageCreationException
-from rules import create_handlers
+from rules import create_handlers, RulesFile
+from dispatch import Dispatcher
+from outbox import OUTBOX
+from handlers.webhook.handler import register_webhooks
 import api
 
 # To ensure that Unicode is handled properly throughout SleekXMPP for
@@ -30,14 +33,15 @@ if sys.version_info < (3, 0):
 
 class XmppListener(sleekxmpp.ClientXMPP):
     """The custom XMPP listener class that forwards each incoming message
-    to our handlers.
+    to our handlers (through the dispatcher).
     """
     
-    def __init__(self, jid, password, handlers):
+    def __init__(self, jid, password, dispatcher, rules_file=None):
         sleekxmpp.ClientXMPP.__init__(self, jid, password)
         self.add_event_handler("session_start", self.start)
         self.add_event_handler("message", self.message)
-        self.handlers = handlers
+        self.dispatcher = dispatcher
+        self.rules_file = rules_file
         
     def start(self, _):
         """Starting up..."""
@@ -47,16 +51,20 @@ class XmppListener(sleekxmpp.ClientXMPP):
     def message(self, msg):
         """Check whether that's a message we are interested in, and if yes
         create an AgileZen message (AZMessage) instance and pass it to 
-        each handler.
+        the dispatcher, which queues it for each handler.
+        If the rules file changed, the new rules apply to this message.
         """
+        if self.rules_file is not None:
+            registry = self.rules_file.reload_if_changed()
+            if registry is not None:
+                self.dispatcher.set_registry(registry)
         if (AZMessage.is_agilezen_xmpp_message(msg)):
             try:
                 az_message = AZMessage(msg)
             except (MessageCreationException, api.APIException) as ex:
                 print ex
                 return None
-            for handler in self.handlers:
-                handler.handle(az_message)
+            self.dispatcher.dispatch(az_message)
 
 def _start_xmpp_listener():
     """Register plugins and create xmpp listener."""
@@ -65,17 +73,43 @@ def _start_xmpp_listener():
     config.read(os.path.join(os.path.dirname(__file__), '..', 'notify.cfg'))
     jid = config.get('xmpp', 'jid')
     password = config.get('xmpp', 'password')
-    xmpp = XmppListener(jid, password, create_handlers())
+    rules_file = _rules_file(config)
+    if rules_file is not None:
+        handlers = rules_file.load()
+    else:
+        handlers = create_handlers()
+    register_webhooks(OUTBOX)
+    dispatcher = Dispatcher(handlers)
+    OUTBOX.start()
+    dispatcher.start()
+    xmpp = XmppListener(jid, password, dispatcher, rules_file)
     xmpp.registerPlugin('xep_0030') # Service Discovery
     xmpp.registerPlugin('xep_0004') # Data Forms
     xmpp.registerPlugin('xep_0060') # PubSub
     xmpp.registerPlugin('xep_0199') # XMPP Ping
     if xmpp.connect(('talk.google.com', 5222)):
         xmpp.process(threaded=False)
+        dispatcher.stop()
+        OUTBOX.stop()
         print("Done")
     else:
         print("Unable to connect.")
 
+def _rules_file(config):
+    """Return the configured rules file, or None if there is none (then
+    the rules defined in create_handlers apply).
+    """
+    path = 'rules.cfg'
+    if config.has_option('rules', 'path'):
+        path = config.get('rules', 'path')
+    path = os.path.join(os.path.dirname(__file__), '..', path)
+    if not os.path.exists(path):
+        return None
+    interval = 10
+    if config.has_option('rules', 'reload_interval'):
+        interval = config.getfloat('rules', 'reload_interval')
+    return RulesFile(path, interval)
+
 def _parse_options():
     """Parse command line options."""
     parser = OptionParser()
@@ -0,0 +1,295 @@
+"""A persistent queue of outbound deliveries (mails, webhook requests), so
+that notifications survive an outage of the receiving server or a restart.
+
+Handlers put payloads on a channel (e.g., 'mail') and return. The delivery
+workers call the function registered for the channel with the payload, in
+parallel but respecting the channel's concurrency and rate limits. If it
+raises, the delivery is retried later, with exponential backoff and jitter.
+After max_attempts attempts, or if it raises PermanentFailure, the delivery
+is dead-lettered: it is kept in the database, but not retried.
+
+The queue is an SQLite database, configured in the [outbox] section.
+"""
+
+import os.path
+import time
+import random
+import pickle
+import sqlite3
+import logging
+import threading
+from ConfigParser import RawConfigParser
+
+CFG_PATH = os.path.join(os.path.dirname(__file__), '..', 'notify.cfg')
+CONFIG = RawConfigParser()
+CONFIG.read(CFG_PATH)
+
+OUTBOX_PATH = 'outbox.db'
+if CONFIG.has_option('outbox', 'path'):
+    OUTBOX_PATH = CONFIG.get('outbox', 'path')
+OUTBOX_PATH = os.path.join(os.path.dirname(__file__), '..', OUTBOX_PATH)
+WORKERS = 2
+if CONFIG.has_option('outbox', 'workers'):
+    WORKERS = CONFIG.getint('outbox', 'workers')
+MAX_ATTEMPTS = 10
+if CONFIG.has_option('outbox', 'max_attempts'):
+    MAX_ATTEMPTS = CONFIG.getint('outbox', 'max_attempts')
+# delay before the first retry, doubled for each further attempt
+BACKOFF = 5
+if CONFIG.has_option('outbox', 'backoff'):
+    BACKOFF = CONFIG.getfloat('outbox', 'backoff')
+MAX_BACKOFF = 3600
+if CONFIG.has_option('outbox', 'max_backoff'):
+    MAX_BACKOFF = CONFIG.getfloat('outbox', 'max_backoff')
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS deliveries (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        channel TEXT NOT NULL,
+        payload BLOB NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        due REAL NOT NULL,
+        dead INTEGER NOT NULL DEFAULT 0,
+        error TEXT)""",
+    """CREATE INDEX IF NOT EXISTS deliveries_due
+        ON deliveries (dead, due)"""]
+
+LOG = logging.getLogger(__name__)
+
+
+class Outbox():
+    """The queue in the SQLite database at path, which is created when it
+    is first used. Deliveries are attempted by the given number of worker
+    threads, once started, or by calling deliver_due().
+    """
+
+    def __init__(self, path, workers=WORKERS, max_attempts=MAX_ATTEMPTS,
+            backoff=BACKOFF, max_backoff=MAX_BACKOFF):
+        self.path = path
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._channels = {}
+        self._db = None
+        self._in_flight = set()
+        self._threads = []
+        self._stopping = False
+        self._changed = threading.Condition()
+
+    def __len__(self):
+        """Return the number of pending (not dead-lettered) deliveries."""
+        with self._changed:
+            return self._connect().execute(
+                'SELECT COUNT(*) FROM deliveries WHERE dead = 0'
+                ).fetchone()[0]
+
+    def register(self, channel, deliver, concurrency=0, rate_limit=0):
+        """Deliver the payloads of the channel by calling deliver(payload),
+        with at most concurrency deliveries at a time and at most
+        rate_limit deliveries per second (0 means no limit). Registering a
+        channel again replaces its function and limits, the deliveries in
+        flight still count. Deliveries of channels that are not registered
+        are kept pending.
+        """
+        with self._changed:
+            state = self._channels.get(channel)
+            if state is None:
+                state = self._channels[channel] = _Channel()
+            state.deliver = deliver
+            state.concurrency = concurrency
+            state.rate_limit = rate_limit
+            self._changed.notify_all()
+
+    def pending_channels(self):
+        """Return the channels that have pending deliveries."""
+        with self._changed:
+            rows = self._connect().execute('SELECT DISTINCT channel '
+                'FROM deliveries WHERE dead = 0').fetchall()
+        return [row[0] for row in rows]
+
+    def put(self, channel, payload):
+        """Persist the payload (a picklable object) for delivery."""
+        data = pickle.dumps(payload, pickle.HIGHEST_PROTOCOL)
+        with self._changed:
+            db = self._connect()
+            db.execute('INSERT INTO deliveries (channel, payload, due) '
+                'VALUES (?, ?, ?)',
+                (channel, sqlite3.Binary(data), time.time()))
+            db.commit()
+            self._changed.notify()
+
+    def start(self):
+        """Start the delivery workers."""
+        self._threads = [threading.Thread(target=self._work, name='outbox')
+            for _ in range(self.workers)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        """Stop the workers once their current delivery is done. Pending
+        deliveries are kept for the next start.
+        """
+        with self._changed:
+            self._stopping = True
+            self._changed.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self._stopping = False
+
+    def deliver_due(self):
+        """Attempt the due deliveries on the calling thread. Return the
+        number of attempts.
+        """
+        count = 0
+        while True:
+            with self._changed:
+                delivery = self._take(time.time())
+            if delivery is None:
+                return count
+            self._deliver(delivery)
+            count += 1
+
+    def dead_letters(self):
+        """Return a list of (channel, payload, error) of the deliveries
+        that were given up, oldest first.
+        """
+        with self._changed:
+            rows = self._connect().execute('SELECT channel, payload, error '
+                'FROM deliveries WHERE dead = 1 ORDER BY id').fetchall()
+        return [(channel, pickle.loads(str(payload)), error)
+            for channel, payload, error in rows]
+
+    def _work(self):
+        while True:
+            with self._changed:
+                while True:
+                    if self._stopping:
+                        return
+                    now = time.time()
+                    delivery = self._take(now)
+                    if delivery is not None:
+                        break
+                    self._changed.wait(self._next_due(now))
+            self._deliver(delivery)
+
+    # return (id, channel, payload, attempts) of the most overdue delivery
+    # that is not in flight, of a registered channel within its limits, or
+    # None
+    def _take(self, now):
+        channels = [channel for channel, state in self._channels.items()
+            if state.available(now)]
+        row = self._connect().execute('SELECT id, channel, payload, attempts '
+            'FROM deliveries WHERE dead = 0 AND due <= ?'
+            + self._filter(channels) + ' ORDER BY due LIMIT 1',
+            [now] + channels + list(self._in_flight)).fetchone()
+        if row is not None:
+            self._in_flight.add(row[0])
+            self._channels[row[1]].started(now)
+        return row
+
+    # return the seconds until the next delivery is due and its channel
+    # may start it, None if there is none (or all wait for a delivery of
+    # their channel to finish)
+    def _next_due(self, now):
+        channels = self._channels.keys()
+        rows = self._connect().execute('SELECT channel, MIN(due) '
+            'FROM deliveries WHERE dead = 0' + self._filter(channels)
+            + ' GROUP BY channel', channels + list(self._in_flight))
+        starts = [max(due, self._channels[channel].next_start)
+            for channel, due in rows
+            if not self._channels[channel].saturated()]
+        if not starts:
+            return None
+        return max(min(starts) - now, 0.01)
+
+    def _filter(self, channels):
+        return ' AND channel IN (%s) AND id NOT IN (%s)' % (
+            ', '.join('?' * len(channels)),
+            ', '.join('?' * len(self._in_flight)))
+
+    def _deliver(self, delivery):
+        id, channel, payload, attempts = delivery
+        state = self._channels[channel]
+        try:
+            state.deliver(pickle.loads(str(payload)))
+        except Exception as err:
+            self._failed(id, channel, attempts + 1, err)
+        else:
+            with self._changed:
+                self._connect().execute(
+                    'DELETE FROM deliveries WHERE id = ?', (id, ))
+                self._connect().commit()
+        finally:
+            with self._changed:
+                self._in_flight.discard(id)
+                state.in_flight -= 1
+                self._changed.notify_all()
+
+    # schedule the next attempt or give up
+    def _failed(self, id, channel, attempts, err):
+        error = '%s: %s' % (err.__class__.__name__, err)
+        if isinstance(err, PermanentFailure) \
+                or attempts >= self.max_attempts:
+            LOG.error('Giving up delivery %d on %s after %d attempts: %s',
+                id, channel, attempts, error)
+            query = 'UPDATE deliveries SET attempts = ?, error = ?, ' \
+                'dead = 1 WHERE id = ?'
+            args = (attempts, error, id)
+        else:
+            delay = min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+            delay *= random.uniform(0.5, 1)
+            LOG.warning('Delivery %d on %s failed, retrying in %.0fs: %s',
+                id, channel, delay, error)
+            query = 'UPDATE deliveries SET attempts = ?, error = ?, ' \
+                'due = ? WHERE id = ?'
+            args = (attempts, error, time.time() + delay, id)
+        with self._changed:
+            self._connect().execute(query, args)
+            self._connect().commit()
+
+    def _connect(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            for statement in SCHEMA:
+                self._db.execute(statement)
+            self._db.commit()
+        return self._db
+
+
+class _Channel():
+    """The delivery function and limits of a channel, and the state needed
+    to enforce them.
+    """
+
+    def __init__(self):
+        self.deliver = None
+        self.concurrency = 0
+        self.rate_limit = 0
+        self.in_flight = 0
+        self.next_start = 0
+
+    def saturated(self):
+        """Return true if concurrency deliveries are in flight."""
+        return self.concurrency and self.in_flight >= self.concurrency
+
+    def available(self, now):
+        """Return true if a delivery may be started."""
+        return not self.saturated() and now >= self.next_start
+
+    def started(self, now):
+        self.in_flight += 1
+        if self.rate_limit:
+            self.next_start = max(now, self.next_start) + 1.0 / self.rate_limit
+
+
+class PermanentFailure(Exception):
+    """Raised by a delivery function if retrying will not help (e.g., the
+    receiver rejected the request).
+    """
+    pass
+
+
+OUTBOX = Outbox(OUTBOX_PATH)
@@ -0,0 +1,114 @@
+"""An index of handlers by the keys of their rules, so that a message is
+only offered to the handlers that can be interested in it.
+
+A handler's interested_in predicate can be a Rule, which declares the event
+types (see message.py) and the project IDs it depends on. The registry
+indexes handlers with such rules by project ID or by event type. Handlers
+with other predicates (arbitrary callables) or with rules that have no keys
+are offered every message.
+"""
+
+
+class Rule():
+    """A callable predicate on messages with declarative keys.
+
+    events: bitset of event types, the message must have one of them
+    project_ids: IDs of projects, the message must belong to one of them
+    test: optional predicate, checked after the keys matched
+    Keys that are None match any message.
+    """
+
+    def __init__(self, events=None, project_ids=None, test=None):
+        self.events = events
+        if project_ids is not None:
+            project_ids = frozenset(project_ids)
+        self.project_ids = project_ids
+        self.test = test
+
+    def __call__(self, msg):
+        if self.events is not None and not msg.events & self.events:
+            return False
+        if self.project_ids is not None \
+                and msg.project_id not in self.project_ids:
+            return False
+        return self.test is None or self.test(msg)
+
+
+def any_of(rules):
+    """Return a rule that matches if any of the given rules matches. Its
+    keys are the union of the rules' keys if all rules are keyed on the same
+    attribute, otherwise it has no keys.
+    """
+    rules = list(rules)
+    if len(rules) == 1:
+        return rules[0]
+    test = lambda msg: any(rule(msg) for rule in rules)
+    if not all(isinstance(rule, Rule) for rule in rules):
+        return Rule(test=test)
+    if all(rule.test is None for rule in rules):
+        test = None
+    if all(rule.events is not None and rule.project_ids is None
+            for rule in rules):
+        return Rule(events=reduce(lambda a, b: a | b,
+            [rule.events for rule in rules]), test=test)
+    if all(rule.project_ids is not None and rule.events is None
+            for rule in rules):
+        return Rule(project_ids=reduce(lambda a, b: a | b,
+            [rule.project_ids for rule in rules]), test=test)
+    return Rule(test=lambda msg: any(rule(msg) for rule in rules))
+
+
+class HandlerRegistry():
+    """Handlers indexed by the keys of their interested_in rules."""
+
+    def __init__(self, handlers=()):
+        self.handlers = []
+        self._by_project = {}
+        self._by_event = {}
+        self._unindexed = []
+        for handler in handlers:
+            self.add(handler)
+
+    def __iter__(self):
+        return iter(self.handlers)
+
+    def __len__(self):
+        return len(self.handlers)
+
+    def add(self, handler):
+        """Register the handler."""
+        entry = (len(self.handlers), handler)
+        self.handlers.append(handler)
+        rule = getattr(handler, 'interested_in', None)
+        if not isinstance(rule, Rule):
+            self._unindexed.append(entry)
+        elif rule.project_ids is not None:
+            for project_id in rule.project_ids:
+                self._by_project.setdefault(project_id, []).append(entry)
+        elif rule.events is not None:
+            for event in _bits(rule.events):
+                self._by_event.setdefault(event, []).append(entry)
+        else:
+            self._unindexed.append(entry)
+
+    def match(self, msg):
+        """Return the handlers that may be interested in the message,
+        in the order they were registered.
+        """
+        found = dict(self._unindexed)
+        project_id = getattr(msg, 'project_id', None)
+        found.update(self._by_project.get(project_id, ()))
+        for event in _bits(getattr(msg, 'events', 0)):
+            found.update(self._by_event.get(event, ()))
+        return [found[order] for order in sorted(found)]
+
+
+def _bits(bitset):
+    """Return a list of the bits set in the integer bitset."""
+    result = []
+    bit = 1
+    while bit <= bitset:
+        if bitset & bit:
+            result.append(bit)
+        bit <<= 1
+    return result
@@ -1,52 +1,56 @@
 """ A specification that determine when and how to activate handlers.
-Modify the method create_handlers() to implement custom behavior.
+Modify the method create_handlers() to implement custom behavior, or define
+the rules in a rules file (see rules.sample.cfg), which is compiled by
+load_rules().
 """
 
+import os.path
+import time
+import logging
+from ConfigParser import RawConfigParser, Error as ConfigParserError
+
 from handlers.debug.handler import PrintHandler
-from handlers.feed.handler import FeedHandler
+from handlers.feed.handler import FeedHandler, MESSAGE_CACHE_SIZE
 from handlers.mail.handler import MailHandler
-from handlers.webhook.handler import WebhookHandler
+from handlers.webhook.handler import WebhookHandler, HOOK_HOST, HOOK_PATH, \
+    FIELDS
+from registry import Rule, HandlerRegistry, any_of
+from message import NEW, MOVED_TO_READY, MARKED_BLOCKED, MARKED_DEPLOYED
 import api
 
 
 def create_handlers(debugging=False):
-    """Return a list of handlers."""
+    """Return a registry of handlers."""
+    # a single mail handler, so that each person gets one mail per message
+    mail = MailHandler(is_moved_to_ready, active_members_without_creator)
+    mail.add_rule(is_marked_blocked, everyone)
+    mail.add_rule(is_marked_deployed, active_members_with_creator)
     handlers = [
-        MailHandler(is_moved_to_ready, active_members_without_creator),
-        MailHandler(is_marked_blocked, everyone),
-        MailHandler(is_marked_deployed, active_members_with_creator),
+        mail,
         FeedHandler(u'AgileZen: all', 'all', always),
         WebhookHandler(is_new) ]
-    def _create_feedhandler(project_id):
-        """Bind project_id within the predicate lambda below."""
-        return FeedHandler(u'AgileZen #' + str(project_id),
-            'project-' + str(project_id),
-            lambda msg: msg.project_id == project_id)
     for project_id in api.get_active_project_ids():
-        handlers.append(_create_feedhandler(project_id))
+        handlers.append(FeedHandler(u'AgileZen #' + str(project_id),
+            'project-' + str(project_id),
+            in_project(project_id)))
     if debugging:
         handlers.append(PrintHandler())      
-    return handlers
-
-def is_new(msg):
-    """See comment in message.py"""
-    return msg.is_new()
-
-def is_marked_blocked(msg):
-    """See comment in message.py"""
-    return msg.is_marked_blocked()
+    return HandlerRegistry(handlers)
 
-def is_marked_deployed(msg):
-    """See comment in message.py"""
-    return msg.is_marked_deployed()
+# Rules declare the event types they depend on (see comments in message.py),
+# hence handlers are only offered messages of these types.
+is_new = Rule(events=NEW)
+is_marked_blocked = Rule(events=MARKED_BLOCKED)
+is_marked_deployed = Rule(events=MARKED_DEPLOYED)
+is_moved_to_ready = Rule(events=MOVED_TO_READY | NEW,
+    test=lambda msg: msg.is_moved_to_ready())
 
-def is_moved_to_ready(msg):
-    """See comment in message.py"""
-    return msg.is_moved_to_ready()
+# For handlers that should trigger in all cases.
+always = Rule()
 
-def always(msg):
-    """For handlers that should trigger in all cases."""
-    return True
+def in_project(project_id):
+    """Return a rule matching the messages of the given project."""
+    return Rule(project_ids=[project_id])
     
 def everyone(msg):
     """Return a list of all mail addresses of all involved people.
@@ -76,3 +80,287 @@ def creators(msg):
     """Return a set with the creator's mail address."""
     creator = msg.creator_mail
     return set((creator, ))
+
+# Names of rules and recipient sets that can be used in a rules file.
+EVENT_RULES = {
+    'new': is_new,
+    'moved_to_ready': is_moved_to_ready,
+    'marked_blocked': is_marked_blocked,
+    'marked_deployed': is_marked_deployed }
+RECIPIENTS = {
+    'everyone': everyone,
+    'active_members': active_members,
+    'active_members_with_creator': active_members_with_creator,
+    'active_members_without_creator': active_members_without_creator,
+    'creators': creators }
+
+# The options of rules file sections by handler type.
+COMMON_OPTIONS = set(['events', 'projects'])
+HANDLER_OPTIONS = {
+    'mail': set(['recipients']),
+    'feed': set(['title', 'filename', 'per_project', 'message_cache_size']),
+    'webhook': set(['host', 'path', 'batch_size', 'batch_interval',
+        'fields', 'concurrency', 'rate_limit']),
+    'debug': set() }
+
+LOG = logging.getLogger(__name__)
+
+
+def load_rules(path, previous=()):
+    """Compile the rules file at path into a registry of handlers.
+    Handlers in previous (e.g., the registry in use) are reused if their
+    rule did not change. Raises RuleConfigException if the file is invalid.
+    """
+    config = RawConfigParser()
+    try:
+        if not config.read(path):
+            raise RuleConfigException('Cannot read rules file ' + path)
+    except ConfigParserError as err:
+        raise RuleConfigException(str(err))
+    return compile_rules(config, previous)
+
+def compile_rules(config, previous=()):
+    """Compile the rules of the config into a registry of handlers. All
+    sections are validated before any handler is created.
+    """
+    specs = []
+    for section in config.sections():
+        specs += _compile_section(config, section)
+    specs = _merge_mail(specs)
+    _check_duplicates(specs)
+    reusable = dict((handler.rule_key, handler) for handler in previous
+        if hasattr(handler, 'rule_key'))
+    # a feed is reused by filename, so that each file has a single writer
+    feeds = dict((handler.filename, handler) for handler in previous
+        if getattr(handler, 'rule_key', ('', ))[0] == 'feed')
+    handlers = []
+    for key, create in specs:
+        handler = reusable.get(key)
+        if handler is None and key[0] == 'feed':
+            handler = feeds.get(key[2])
+        handler = create(handler)
+        handler.rule_key = key
+        handlers.append(handler)
+    return HandlerRegistry(handlers)
+
+def _compile_section(config, section):
+    """Return a list of (key, factory) tuples for the handlers defined by
+    the section. Equal keys denote equal handlers. The factory is called
+    with the handler of the previous rules having the same key (or None)
+    and returns the handler to use.
+    """
+    kind, _, name = section.partition(':')
+    if kind not in HANDLER_OPTIONS:
+        raise RuleConfigException(
+            'Unknown handler type in section [' + section + ']')
+    options = dict(config.items(section))
+    unknown = set(options) - COMMON_OPTIONS - HANDLER_OPTIONS[kind]
+    if unknown:
+        raise RuleConfigException('Unknown options in section ['
+            + section + ']: ' + ', '.join(sorted(unknown)))
+    events = _parse_events(options.get('events', ''), section)
+    project_ids = _parse_projects(options.get('projects'), section)
+    if kind == 'mail':
+        recipients = options.get('recipients')
+        if recipients not in RECIPIENTS:
+            raise RuleConfigException('Unknown or missing recipients in '
+                + 'section [' + section + ']')
+        rule = _compile_rule(events, project_ids)
+        return [(('mail', events, project_ids, recipients),
+            lambda previous: previous
+                or MailHandler(rule, RECIPIENTS[recipients]))]
+    if kind == 'feed':
+        return _compile_feeds(config, section, name, options, events,
+            project_ids)
+    if kind == 'webhook':
+        host = options.get('host', HOOK_HOST)
+        path = options.get('path', HOOK_PATH)
+        try:
+            batch_size = int(options.get('batch_size', 0))
+            batch_interval = float(options.get('batch_interval', 0))
+            concurrency = int(options.get('concurrency', 0))
+            rate_limit = float(options.get('rate_limit', 0))
+        except ValueError:
+            raise RuleConfigException(
+                'Invalid option value in section [' + section + ']')
+        fields = _parse_fields(options.get('fields'), section)
+        rule = _compile_rule(events, project_ids)
+        return [(('webhook', events, project_ids, host, path, batch_size,
+                batch_interval, section, fields, concurrency, rate_limit),
+            lambda previous: previous or WebhookHandler(rule, host, path,
+                batch_size=batch_size, batch_interval=batch_interval,
+                name=name or section, fields=fields,
+                concurrency=concurrency, rate_limit=rate_limit))]
+    return [(('debug', section), lambda previous: previous or PrintHandler())]
+
+def _merge_mail(specs):
+    """Replace the specs of mail handlers by the spec of a single handler
+    with all their rules, so that a message matching several of them is
+    mailed once to each recipient. It is placed at the first mail spec.
+    """
+    mail = [spec for spec in specs if spec[0][0] == 'mail']
+    if len(mail) < 2:
+        return specs
+    def _create(previous):
+        if previous is not None:
+            return previous
+        handlers = [create(None) for _, create in mail]
+        for each in handlers[1:]:
+            for interested_in, getrecipients in each.rules:
+                handlers[0].add_rule(interested_in, getrecipients)
+        return handlers[0]
+    index = specs.index(mail[0])
+    specs = [spec for spec in specs if spec[0][0] != 'mail']
+    specs.insert(index, (('mail', ) + tuple(key for key, _ in mail), _create))
+    return specs
+
+def _check_duplicates(specs):
+    """Raise RuleConfigException if two specs have the same key or two
+    feeds would write the same file.
+    """
+    keys = set()
+    filenames = set()
+    for key, _ in specs:
+        if key in keys:
+            raise RuleConfigException('Duplicate handler ' + repr(key))
+        keys.add(key)
+        if key[0] == 'feed':
+            if key[2] in filenames:
+                raise RuleConfigException(
+                    'Several feeds write to the file ' + key[2])
+            filenames.add(key[2])
+
+def _compile_feeds(config, section, name, options, events, project_ids):
+    """Return the specs of a feed, or of a feed per project if per_project
+    is set. Then, {project_id} in title and filename is replaced by the
+    project ID. Without projects option, there is a feed for each active
+    project. A changed title, rule or message_cache_size is applied to the
+    existing feed of the file.
+    """
+    title = options.get('title', 'AgileZen: ' + name).decode('utf-8')
+    filename = options.get('filename', name)
+    try:
+        per_project = config.has_option(section, 'per_project') \
+            and config.getboolean(section, 'per_project')
+        cache_size = None
+        if config.has_option(section, 'message_cache_size'):
+            cache_size = config.getint(section, 'message_cache_size')
+    except ValueError:
+        raise RuleConfigException(
+            'Invalid option value in section [' + section + ']')
+    def _create(feed_title, feed_filename, rule):
+        """Return the factory of a feed."""
+        def _factory(previous):
+            if previous is None:
+                return FeedHandler(feed_title, feed_filename, rule,
+                    cache_size=cache_size)
+            previous.resize(cache_size or MESSAGE_CACHE_SIZE)
+            previous.reconfigure(feed_title, rule)
+            return previous
+        return _factory
+    if not per_project:
+        rule = _compile_rule(events, project_ids)
+        return [(('feed', title, filename, events, project_ids),
+            _create(title, filename, rule))]
+    def _spec(project_id):
+        """Bind project_id within the factory below."""
+        feed_title = title.replace('{project_id}', str(project_id))
+        feed_filename = filename.replace('{project_id}', str(project_id))
+        rule = _compile_rule(events, (project_id, ))
+        return (('feed', feed_title, feed_filename, events, project_id),
+            _create(feed_title, feed_filename, rule))
+    if project_ids is None:
+        project_ids = api.get_active_project_ids()
+    return [_spec(project_id) for project_id in project_ids]
+
+def _compile_rule(events, project_ids):
+    """Return the rule matching any of the event types (any if empty)
+    in the projects (any if None)."""
+    rule = any_of([EVENT_RULES[event] for event in events] or [always])
+    if project_ids is None:
+        return rule
+    return Rule(rule.events, project_ids, rule.test)
+
+def _parse_events(spec, section):
+    """Parse a comma separated list of event type names."""
+    events = tuple(sorted(set(each.strip() for each in spec.split(',')
+        if each.strip())))
+    for event in events:
+        if event not in EVENT_RULES:
+            raise RuleConfigException('Unknown event type ' + event
+                + ' in section [' + section + ']')
+    return events
+
+def _parse_fields(spec, section):
+    """Parse a comma separated list of webhook payload fields. Return all
+    fields if not specified.
+    """
+    if spec is None:
+        return FIELDS
+    fields = tuple(each.strip() for each in spec.split(',') if each.strip())
+    for field in fields:
+        if field not in FIELDS:
+            raise RuleConfigException('Unknown field ' + field
+                + ' in section [' + section + ']')
+    return fields
+
+def _parse_projects(spec, section):
+    """Parse a comma separated list of project IDs. Return None if not
+    specified.
+    """
+    if spec is None:
+        return None
+    try:
+        return tuple(sorted(set(int(each) for each in spec.split(','))))
+    except ValueError:
+        raise RuleConfigException(
+            'Invalid project IDs in section [' + section + ']')
+
+
+class RulesFile():
+    """A rules file that is compiled again when it changes. The file's
+    modification time is checked at most every check_interval seconds.
+    """
+
+    def __init__(self, path, check_interval=10):
+        self.path = path
+        self.check_interval = check_interval
+        self.registry = None
+        self._mtime = None
+        self._next_check = 0
+
+    def load(self):
+        """Compile the rules file and return the registry."""
+        self._mtime = os.path.getmtime(self.path)
+        self._next_check = time.time() + self.check_interval
+        self.registry = load_rules(self.path, self.registry or ())
+        return self.registry
+
+    def reload_if_changed(self):
+        """Return the new registry if the file changed and compiles
+        successfully, None otherwise. If it does not compile, the error is
+        logged and the current registry is kept.
+        """
+        now = time.time()
+        if now < self._next_check:
+            return None
+        self._next_check = now + self.check_interval
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return None
+        if mtime == self._mtime:
+            return None
+        self._mtime = mtime
+        try:
+            self.registry = load_rules(self.path, self.registry or ())
+        except (RuleConfigException, api.APIException) as err:
+            LOG.error('Keeping the current rules: %s', err)
+            return None
+        LOG.info('Reloaded the rules from %s', self.path)
+        return self.registry
+
+
+class RuleConfigException(Exception):
+    """Raised when the rules file is invalid."""
+    pass
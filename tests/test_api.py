@@ -0,0 +1,87 @@
+import unittest
+from mock import Mock
+
+import api
+
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.loaded = []
+        self.cache = api.Cache(ttl=60, max_entries=2)
+
+    def load(self, key):
+        self.loaded.append(key)
+        return key * 2
+
+    def test_hit_does_not_reload(self):
+        self.assertEqual(self.cache.get(1, self.load), 2)
+        self.assertEqual(self.cache.get(1, self.load), 2)
+        self.assertEqual(self.loaded, [1])
+
+    def test_refresh_and_invalidate(self):
+        self.cache.get(1, self.load)
+        self.cache.get(1, self.load, refresh=True)
+        self.cache.invalidate(1)
+        self.cache.get(1, self.load)
+        self.assertEqual(self.loaded, [1, 1, 1])
+
+    def test_expired_entry_is_reloaded(self):
+        self.cache.ttl = 0
+        self.cache.get(1, self.load)
+        self.cache.get(1, self.load)
+        self.assertEqual(self.loaded, [1, 1])
+
+    def test_least_recently_used_is_evicted(self):
+        self.cache.get(1, self.load)
+        self.cache.get(2, self.load)
+        self.cache.get(1, self.load)
+        self.cache.get(3, self.load)
+        self.cache.get(1, self.load)
+        self.cache.get(2, self.load)
+        self.assertEqual(self.loaded, [1, 2, 3, 2])
+
+
+class TestProjectIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.get_projects = api.get_projects
+        api.get_projects = Mock(return_value={'items': [
+            {'id': 1, 'name': 'Foo'}, {'id': '2', 'name': 'Bar'}]})
+        self.index = api.ProjectIndex(ttl=60)
+
+    def tearDown(self):
+        api.get_projects = self.get_projects
+
+    def test_lookup(self):
+        self.assertEqual(self.index.lookup('Foo'), 1)
+        self.assertEqual(self.index.lookup('Bar'), 2)
+        self.assertEqual(self.index.active_ids(), [1, 2])
+        self.assertEqual(api.get_projects.call_count, 1)
+
+    def test_unknown_name_refreshes_index(self):
+        self.index.miss_interval = 0
+        self.index.lookup('Foo')
+        api.get_projects.return_value = {'items': [
+            {'id': 1, 'name': 'Foo'}, {'id': 3, 'name': 'New'}]}
+        self.assertEqual(self.index.lookup('New'), 3)
+        self.assertRaises(api.APIException, self.index.lookup, 'Bar')
+        self.assertEqual(api.get_projects.call_count, 3)
+
+    def test_unknown_names_are_remembered(self):
+        self.index.miss_interval = 0
+        self.assertRaises(api.APIException, self.index.lookup, 'Old')
+        self.assertRaises(api.APIException, self.index.lookup, 'Old')
+        self.assertEqual(api.get_projects.call_count, 2)
+
+    def test_refreshes_on_unknown_names_are_limited(self):
+        self.index.lookup('Foo')
+        self.assertRaises(api.APIException, self.index.lookup, 'Old')
+        self.assertRaises(api.APIException, self.index.lookup, 'Older')
+        self.assertEqual(api.get_projects.call_count, 1)
+
+    def test_expired_index_is_rebuilt(self):
+        self.index.ttl = 0
+        self.index.lookup('Foo')
+        self.index.lookup('Foo')
+        self.assertEqual(api.get_projects.call_count, 2)
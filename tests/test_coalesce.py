@@ -0,0 +1,39 @@
+import unittest
+import threading
+
+from handlers.coalesce import FlushTimer
+
+
+class TestFlushTimer(unittest.TestCase):
+
+    def setUp(self):
+        self.flushed = threading.Event()
+        self.calls = []
+        self.timer = FlushTimer(self.flush)
+
+    def tearDown(self):
+        self.timer.cancel()
+
+    def flush(self):
+        self.calls.append(self.timer.scheduled)
+        self.flushed.set()
+
+    def test_flush_after_delay(self):
+        self.timer.schedule(0.01)
+        self.assertTrue(self.timer.scheduled)
+        self.assertTrue(self.flushed.wait(5))
+        self.assertEqual(self.calls, [False])
+        self.assertFalse(self.timer.scheduled)
+
+    def test_schedule_does_not_postpone(self):
+        self.timer.schedule(0.01)
+        self.timer.schedule(60)
+        self.assertTrue(self.flushed.wait(5))
+
+    def test_cancel(self):
+        self.timer.schedule(60)
+        self.timer.cancel()
+        self.assertFalse(self.timer.scheduled)
+        self.timer.schedule(0.01)
+        self.assertTrue(self.flushed.wait(5))
+        self.assertEqual(self.calls, [False])
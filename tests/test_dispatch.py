@@ -0,0 +1,159 @@
+import unittest
+from mock import Mock
+
+import dispatch
+from registry import Rule, HandlerRegistry
+
+
+class RecordingHandler():
+
+    def __init__(self):
+        self.messages = []
+
+    def handle(self, message):
+        if message == 'fail':
+            raise Exception('handler failed')
+        self.messages.append(message)
+
+
+class TestDispatcher(unittest.TestCase):
+
+    def test_messages_are_handled_in_order(self):
+        handlers = [RecordingHandler(), RecordingHandler()]
+        dispatcher = dispatch.Dispatcher(handlers, workers=3, queue_size=5)
+        dispatcher.start()
+        for i in range(20):
+            dispatcher.dispatch(i)
+        dispatcher.stop()
+        for handler in handlers:
+            self.assertEqual(handler.messages, range(20))
+
+    def test_failing_handler_does_not_stop_dispatching(self):
+        handler = RecordingHandler()
+        dispatcher = dispatch.Dispatcher([handler], workers=1)
+        dispatcher.start()
+        for message in (1, 'fail', 2):
+            dispatcher.dispatch(message)
+        dispatcher.stop()
+        self.assertEqual(handler.messages, [1, 2])
+
+    def test_drop_newest(self):
+        handler = RecordingHandler()
+        dispatcher = dispatch.Dispatcher([handler], workers=1, queue_size=2,
+            policy=dispatch.DROP_NEWEST)
+        for i in range(4):
+            dispatcher.dispatch(i)
+        self.assertEqual(dispatcher.queue_depths(),
+            [(dispatch.DEFAULT_EXECUTOR, handler, 2)])
+        dispatcher.start()
+        dispatcher.stop()
+        self.assertEqual(handler.messages, [0, 1])
+
+    def test_drop_oldest(self):
+        handler = RecordingHandler()
+        dispatcher = dispatch.Dispatcher([handler], workers=1, queue_size=2,
+            policy=dispatch.DROP_OLDEST)
+        for i in range(4):
+            dispatcher.dispatch(i)
+        dispatcher.start()
+        dispatcher.stop()
+        self.assertEqual(handler.messages, [2, 3])
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, dispatch.Dispatcher, [], policy='foo')
+
+    def test_handlers_run_on_their_executor(self):
+        mail, other = RecordingHandler(), RecordingHandler()
+        mail.executor = 'mail'
+        dispatcher = dispatch.Dispatcher([mail, other],
+            executors={'mail': 1})
+        dispatcher.dispatch(1)
+        self.assertEqual(dispatcher.queue_depths(),
+            [('mail', mail, 1), (dispatch.DEFAULT_EXECUTOR, other, 1)])
+        dispatcher.start()
+        dispatcher.stop()
+        self.assertEqual(mail.messages, [1])
+        self.assertEqual(other.messages, [1])
+
+    def test_messages_are_routed_by_registry(self):
+        matching = RecordingHandler()
+        matching.interested_in = Rule(project_ids=[1])
+        other = RecordingHandler()
+        other.interested_in = Rule(project_ids=[2])
+        dispatcher = dispatch.Dispatcher(HandlerRegistry([matching, other]))
+        dispatcher.dispatch(FakeMessage(1))
+        self.assertEqual([depth for _, _, depth in dispatcher.queue_depths()],
+            [1, 0])
+
+
+class FakeMessage():
+
+    def __init__(self, project_id):
+        self.project_id = project_id
+
+
+class WarmUpHandler(RecordingHandler):
+
+    def __init__(self):
+        RecordingHandler.__init__(self)
+        self.warmed_up = 0
+
+    def warm_up(self):
+        self.warmed_up += 1
+
+
+class ClosingHandler(RecordingHandler):
+
+    def __init__(self):
+        RecordingHandler.__init__(self)
+        self.closed = []
+
+    def close(self):
+        self.closed.append(len(self.messages))
+
+
+class TestWarmUp(unittest.TestCase):
+
+    def test_handlers_are_warmed_up_in_parallel(self):
+        handlers = [WarmUpHandler() for _ in range(5)] + [RecordingHandler()]
+        dispatcher = dispatch.Dispatcher(handlers)
+        threads = dispatcher.warm_up(handlers, workers=2)
+        self.assertEqual(len(threads), 2)
+        for thread in threads:
+            thread.join()
+        self.assertEqual([each.warmed_up for each in handlers[:5]], [1] * 5)
+
+    def test_added_handlers_are_warmed_up(self):
+        old, new = WarmUpHandler(), WarmUpHandler()
+        dispatcher = dispatch.Dispatcher([old], workers=1, executors={})
+        dispatcher.warm_up = Mock()
+        dispatcher.start()
+        dispatcher.warm_up.assert_called_once_with(dispatcher.registry)
+        dispatcher.set_registry([old, new])
+        dispatcher.warm_up.assert_called_with([new])
+        dispatcher.stop()
+
+
+class TestSetRegistry(unittest.TestCase):
+
+    def test_removed_handlers_are_closed_after_their_messages(self):
+        old, idle, new = ClosingHandler(), ClosingHandler(), ClosingHandler()
+        dispatcher = dispatch.Dispatcher([old], workers=1, executors={})
+        for i in range(3):
+            dispatcher.dispatch(i)
+        dispatcher.set_registry([idle])
+        self.assertEqual(old.closed, [])
+        dispatcher.set_registry([new])
+        self.assertEqual(idle.closed, [0])
+        dispatcher.start()
+        dispatcher.stop()
+        self.assertEqual(old.closed, [3])
+        self.assertEqual(idle.closed, [0])
+        self.assertEqual(new.closed, [0])
+
+    def test_added_handlers_register_their_channels(self):
+        old, new = Mock(), Mock()
+        dispatcher = dispatch.Dispatcher([old], workers=1, executors={})
+        dispatcher.set_registry([old, new])
+        old.register_channels.assert_called_once_with()
+        new.register_channels.assert_called_once_with()
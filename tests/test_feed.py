@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+import tempfile
+import shutil
+import pickle
+import os.path
+from datetime import datetime
+from xml.dom import minidom
+
+from handlers.feed import handler, files
+from handlers.feed.store import MessageStore
+from handlers.feed.journal import Journal
+from test_message import BASELINE_STATE, baseline_pickle
+
+
+class FakeMessage():
+
+    def __init__(self, number, project_id=1):
+        self.guid = 'https://agilezen.com/project/1/story/1#' + str(number)
+        self.title = u'Story ä #' + str(number)
+        self.link = 'https://agilezen.com/project/1/story/1'
+        self.content = u'<p>Content ä ' + str(number) + '</p>'
+        self.pubdate = datetime(2011, 1, 1, 0, 0, number)
+        self.categories = []
+        self.causer = 'John Doe'
+        self.project_id = project_id
+
+
+class FeedTestCase(unittest.TestCase):
+    """Writes the feeds to a temporary directory, without delay."""
+
+    def setUp(self):
+        self.feed_path = handler.FEED_PATH
+        self.store = handler.STORE
+        self.flush_interval = handler.FLUSH_INTERVAL
+        handler.FEED_PATH = tempfile.mkdtemp()
+        handler.STORE = self.new_store()
+        handler.FLUSH_INTERVAL = 0
+
+    def tearDown(self):
+        shutil.rmtree(handler.FEED_PATH)
+        handler.FEED_PATH = self.feed_path
+        handler.STORE = self.store
+        handler.FLUSH_INTERVAL = self.flush_interval
+
+    def new_store(self):
+        return MessageStore(os.path.join(handler.FEED_PATH, 'messages'))
+
+    def read_entry_ids(self, filename):
+        path = os.path.join(handler.FEED_PATH, filename + '.xml')
+        document = minidom.parse(path)
+        return [entry.getElementsByTagName('id')[0].firstChild.data
+            for entry in document.getElementsByTagName('entry')]
+
+
+class TestFeedHandler(FeedTestCase):
+
+    def test_history_is_loaded_on_warm_up(self):
+        feed = handler.FeedHandler(u'Test', 'test', lambda msg: True)
+        self.assertEqual(os.listdir(handler.FEED_PATH), [])
+        feed.warm_up()
+        self.assertEqual(self.read_entry_ids('test'), [])
+
+    def test_feed_contains_newest_messages_first(self):
+        feed = handler.FeedHandler(u'Test', 'test', lambda msg: True)
+        for number in range(3):
+            feed.handle(FakeMessage(number))
+        self.assertEqual(self.read_entry_ids('test'),
+            [FakeMessage(number).guid for number in (2, 1, 0)])
+
+    def test_reconfigured_feed_is_written_with_new_title(self):
+        feed = handler.FeedHandler(u'Test', 'test', lambda msg: True)
+        feed.handle(FakeMessage(1))
+        feed.reconfigure(u'Renamed', lambda msg: False)
+        path = os.path.join(handler.FEED_PATH, 'test.xml')
+        title = minidom.parse(path).getElementsByTagName('title')[0]
+        self.assertEqual(title.firstChild.data, u'Renamed')
+        feed.handle(FakeMessage(2))
+        self.assertEqual(self.read_entry_ids('test'), [FakeMessage(1).guid])
+
+    def test_entries_are_serialized_once(self):
+        feed = handler.FeedHandler(u'Test', 'test', lambda msg: True)
+        created = []
+        create_fragment = feed._create_fragment
+        def _create_fragment(generator, message):
+            created.append(message.guid)
+            return create_fragment(generator, message)
+        feed._create_fragment = _create_fragment
+        for number in range(3):
+            feed.handle(FakeMessage(number))
+        self.assertEqual(created,
+            [FakeMessage(number).guid for number in range(3)])
+
+    def test_messages_are_restored(self):
+        feed = handler.FeedHandler(u'Test', 'test', lambda msg: True)
+        feed.handle(FakeMessage(1))
+        restored = handler.FeedHandler(u'Test', 'test', lambda msg: True,
+            self.new_store())
+        restored.flush()
+        self.assertEqual([each.guid for each in restored.messages],
+            [FakeMessage(1).guid])
+        self.assertEqual(restored.messages[0].content, FakeMessage(1).content)
+
+    def test_messages_of_earlier_versions_are_restored(self):
+        path = os.path.join(handler.FEED_PATH, 'test.pkl')
+        pickle.dump([FakeMessage(2), FakeMessage(1)], open(path, 'wb'))
+        feed = handler.FeedHandler(u'Test', 'test', lambda msg: True)
+        feed.warm_up()
+        self.assertEqual(list(feed.guids),
+            [FakeMessage(2).guid, FakeMessage(1).guid])
+        self.assertEqual(self.read_entry_ids('test'), list(feed.guids))
+        self.assertFalse(os.path.exists(path))
+        restored = handler.FeedHandler(u'Test', 'test', lambda msg: True,
+            self.new_store())
+        restored.flush()
+        self.assertEqual(restored.guids, feed.guids)
+
+    def test_feed_of_baseline_version_is_converted(self):
+        path = os.path.join(handler.FEED_PATH, 'test.pkl')
+        states = [dict(BASELINE_STATE, guid=BASELINE_STATE['guid'] + str(n))
+            for n in (2, 1)]
+        with open(path, 'wb') as file:
+            file.write(baseline_pickle(states))
+        feed = handler.FeedHandler(u'Test', 'test', lambda msg: True)
+        feed.flush()
+        self.assertEqual(self.read_entry_ids('test'),
+            [state['guid'] for state in states])
+        self.assertFalse(os.path.exists(path))
+        restored = handler.FeedHandler(u'Test', 'test', lambda msg: True,
+            self.new_store())
+        restored.flush()
+        self.assertEqual(restored.messages[0].content,
+            BASELINE_STATE['content'])
+
+    def test_messages_that_cannot_be_converted_are_skipped(self):
+        path = os.path.join(handler.FEED_PATH, 'test.pkl')
+        pickle.dump([FakeMessage(2), object(), FakeMessage(1)],
+            open(path, 'wb'))
+        feed = handler.FeedHandler(u'Test', 'test', lambda msg: True)
+        feed.flush()
+        self.assertEqual(list(feed.guids),
+            [FakeMessage(2).guid, FakeMessage(1).guid])
+
+    def test_unreadable_pickle_is_renamed(self):
+        path = os.path.join(handler.FEED_PATH, 'test.pkl')
+        with open(path, 'wb') as file:
+            file.write('garbage')
+        feed = handler.FeedHandler(u'Test', 'test', lambda msg: True)
+        feed.flush()
+        self.assertEqual(self.read_entry_ids('test'), [])
+        self.assertTrue(os.path.exists(path + '.failed'))
+
+    def test_journal_is_compacted(self):
+        feed = handler.FeedHandler(u'Test', 'test', lambda msg: True,
+            cache_size=2)
+        for number in range(5):
+            feed.handle(FakeMessage(number))
+        self.assertEqual(feed.journal.count, 2)
+        feed.handle(FakeMessage(5))
+        self.assertEqual(feed.journal.count, 3)
+        restored = handler.FeedHandler(u'Test', 'test', lambda msg: True,
+            self.new_store(), cache_size=2)
+        restored.flush()
+        self.assertEqual(list(restored.guids),
+            [FakeMessage(5).guid, FakeMessage(4).guid])
+
+    def test_resize(self):
+        feed = handler.FeedHandler(u'Test', 'test', lambda msg: True,
+            cache_size=3)
+        for number in range(3):
+            feed.handle(FakeMessage(number))
+        feed.resize(2)
+        self.assertEqual(self.read_entry_ids('test'),
+            [FakeMessage(2).guid, FakeMessage(1).guid])
+        self.assertEqual(len(handler.STORE), 2)
+        feed.resize(4)
+        for number in range(3, 6):
+            feed.handle(FakeMessage(number))
+        self.assertEqual(len(self.read_entry_ids('test')), 4)
+        restored = handler.FeedHandler(u'Test', 'test', lambda msg: True,
+            self.new_store(), cache_size=4)
+        restored.flush()
+        self.assertEqual(restored.guids, feed.guids)
+
+    def test_feeds_share_messages(self):
+        feeds = [handler.FeedHandler(u'Test', name, lambda msg: True)
+            for name in ('a', 'b')]
+        for feed in feeds:
+            feed.handle(FakeMessage(1))
+        self.assertEqual(len(handler.STORE), 1)
+        self.assertEqual(
+            len(os.listdir(os.path.join(handler.FEED_PATH, 'messages'))), 1)
+
+    def test_evicted_messages_are_deleted(self):
+        feed = handler.FeedHandler(u'Test', 'test', lambda msg: True,
+            cache_size=2)
+        for number in range(4):
+            feed.handle(FakeMessage(number))
+        self.assertEqual(self.read_entry_ids('test'),
+            [FakeMessage(3).guid, FakeMessage(2).guid])
+        self.assertEqual(len(handler.STORE), 2)
+        self.assertEqual(handler.collect_garbage([feed]), 2)
+        self.assertEqual(
+            len(os.listdir(os.path.join(handler.FEED_PATH, 'messages'))), 2)
+
+    def test_existing_feed_is_not_loaded_on_warm_up(self):
+        feed = handler.FeedHandler(u'Test', 'test', lambda msg: True)
+        feed.handle(FakeMessage(1))
+        restored = handler.FeedHandler(u'Test', 'test', lambda msg: True,
+            self.new_store())
+        restored.warm_up()
+        self.assertFalse(restored._loaded)
+        self.assertEqual(len(restored.store), 0)
+        restored.handle(FakeMessage(2))
+        self.assertEqual(self.read_entry_ids('test'),
+            [FakeMessage(2).guid, FakeMessage(1).guid])
+
+    def test_idle_feed_is_released(self):
+        feed = handler.FeedHandler(u'Test', 'test', lambda msg: True)
+        feed.handle(FakeMessage(1))
+        self.assertFalse(feed.release_if_idle(60))
+        self.assertTrue(feed.release_if_idle(60, feed._last_used + 60))
+        self.assertEqual(len(handler.STORE), 0)
+        self.assertEqual(list(feed.guids), [])
+        feed.handle(FakeMessage(2))
+        self.assertEqual(list(feed.guids),
+            [FakeMessage(2).guid, FakeMessage(1).guid])
+
+    def test_messages_of_released_feeds_are_kept(self):
+        feeds = [handler.FeedHandler(u'Test', name, lambda msg: True,
+                cache_size=1)
+            for name in ('a', 'b')]
+        for feed in feeds:
+            feed.handle(FakeMessage(1))
+        feeds[0].release_if_idle(0)
+        feeds[1].handle(FakeMessage(2))
+        self.assertEqual(handler.collect_garbage(feeds), 0)
+        feeds[0].flush()
+        self.assertEqual([each.guid for each in feeds[0].messages],
+            [FakeMessage(1).guid])
+        feeds[0].handle(FakeMessage(3))
+        self.assertEqual(handler.collect_garbage(feeds), 1)
+
+
+class TestCoalescedWrites(FeedTestCase):
+
+    def setUp(self):
+        FeedTestCase.setUp(self)
+        self.flush_pending = handler.FLUSH_PENDING
+        handler.FLUSH_INTERVAL = 60
+        handler.FLUSH_PENDING = 3
+        self.feed = handler.FeedHandler(u'Test', 'test', lambda msg: True)
+
+    def tearDown(self):
+        self.feed.close()
+        handler.FLUSH_PENDING = self.flush_pending
+        FeedTestCase.tearDown(self)
+
+    def test_feed_is_written_after_pending_messages(self):
+        for number in range(2):
+            self.feed.handle(FakeMessage(number))
+        self.assertEqual(self.read_entry_ids('test'), [])
+        self.feed.handle(FakeMessage(2))
+        self.assertEqual(len(self.read_entry_ids('test')), 3)
+        self.assertFalse(self.feed._timer.scheduled)
+
+    def test_feed_is_written_on_close(self):
+        self.feed.handle(FakeMessage(1))
+        self.assertTrue(self.feed._timer.scheduled)
+        self.feed.close()
+        self.assertEqual(self.read_entry_ids('test'), [FakeMessage(1).guid])
+        self.assertFalse(self.feed._timer.scheduled)
+
+
+class TestWriteAtomically(FeedTestCase):
+
+    def test_write(self):
+        path = os.path.join(handler.FEED_PATH, 'test.xml')
+        for durability in (files.NONE, files.FILE, files.DIR):
+            files.write_atomically(path,
+                lambda file: file.write(durability), durability)
+            self.assertEqual(open(path).read(), durability)
+        self.assertEqual(os.listdir(handler.FEED_PATH), ['test.xml'])
+
+    def test_failed_write_keeps_file(self):
+        path = os.path.join(handler.FEED_PATH, 'test.xml')
+        files.write_atomically(path, lambda file: file.write('old'))
+        def _write(file):
+            file.write('new')
+            raise IOError('disk full')
+        self.assertRaises(IOError, files.write_atomically, path, _write)
+        self.assertEqual(open(path).read(), 'old')
+        self.assertEqual(os.listdir(handler.FEED_PATH), ['test.xml'])
+
+
+class TestJournal(FeedTestCase):
+
+    def setUp(self):
+        FeedTestCase.setUp(self)
+        self.path = os.path.join(handler.FEED_PATH, 'test.journal')
+        self.journal = Journal(self.path)
+
+    def test_replay(self):
+        self.assertEqual(self.journal.replay(), [])
+        for record in ('a', 'b', u'c'):
+            self.journal.append(record)
+        self.assertEqual(Journal(self.path).replay(), ['a', 'b', u'c'])
+        self.journal.rewrite(['c'])
+        self.assertEqual(Journal(self.path).replay(), ['c'])
+
+    def test_partly_written_record_is_discarded(self):
+        self.journal.append('a')
+        self.journal.append('b')
+        size = os.path.getsize(self.path)
+        with open(self.path, 'r+b') as file:
+            file.truncate(size - 1)
+        journal = Journal(self.path)
+        self.assertEqual(journal.replay(), ['a'])
+        journal.append('c')
+        self.assertEqual(Journal(self.path).replay(), ['a', 'c'])
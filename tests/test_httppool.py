@@ -0,0 +1,118 @@
+import unittest
+import socket
+import httplib
+
+import httppool
+
+
+class FakeResponse():
+
+    def __init__(self, status, data):
+        self.status = status
+        self.data = data
+        self.will_close = False
+
+    def read(self):
+        return self.data
+
+
+class FakeConnection():
+    """Stands in for httplib.HTTPConnection. Instances are recorded so
+    that tests can check how many connections have been opened.
+    """
+
+    instances = []
+    failures = []
+
+    def __init__(self, host, timeout=None):
+        self.host = host
+        self.sock = object()
+        self.requests = []
+        FakeConnection.instances.append(self)
+
+    def request(self, method, path, body=None, headers=None):
+        if FakeConnection.failures:
+            raise FakeConnection.failures.pop(0)
+        self.requests.append((method, path))
+
+    def getresponse(self):
+        return FakeResponse(httplib.OK, '{"items": []}')
+
+    def close(self):
+        self.sock = None
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        FakeConnection.instances = []
+        FakeConnection.failures = []
+        self.pool = httppool.ConnectionPool('example.com', size=2,
+            idle_timeout=60, connection_class=FakeConnection)
+
+    def test_connection_is_reused(self):
+        self.pool.request('GET', '/a')
+        status, data = self.pool.request('GET', '/b')
+        self.assertEqual(status, httplib.OK)
+        self.assertEqual(data, '{"items": []}')
+        self.assertEqual(len(FakeConnection.instances), 1)
+        self.assertEqual(FakeConnection.instances[0].requests,
+            [('GET', '/a'), ('GET', '/b')])
+
+    def test_idle_connection_expires(self):
+        self.pool.idle_timeout = 0
+        self.pool.request('GET', '/a')
+        self.pool.request('GET', '/b')
+        self.assertEqual(len(FakeConnection.instances), 2)
+        self.assertTrue(FakeConnection.instances[0].sock is None)
+
+    def test_reconnect_on_broken_pipe(self):
+        self.pool.request('GET', '/a')
+        FakeConnection.failures = [socket.error(32, 'Broken pipe')]
+        self.pool.request('GET', '/b')
+        self.assertEqual(len(FakeConnection.instances), 2)
+        self.assertEqual(FakeConnection.instances[1].requests,
+            [('GET', '/b')])
+
+    def test_reconnect_on_closed_connection(self):
+        self.pool.request('GET', '/a')
+        FakeConnection.failures = [httplib.BadStatusLine('')]
+        self.pool.request('GET', '/b')
+        self.assertEqual(len(FakeConnection.instances), 2)
+
+    def test_timeout_is_not_retried(self):
+        self.pool.request('GET', '/a')
+        FakeConnection.failures = [socket.timeout('timed out')]
+        self.assertRaises(httppool.PoolException, self.pool.request,
+            'PUT', '/b')
+        self.assertEqual(len(FakeConnection.instances), 1)
+
+    def test_fresh_connection_failure_raises(self):
+        FakeConnection.failures = [socket.error(111, 'Connection refused')]
+        self.assertRaises(httppool.PoolException, self.pool.request,
+            'GET', '/a')
+        self.pool.request('GET', '/b')
+
+    def test_stats(self):
+        self.pool.request('GET', '/a')
+        FakeConnection.failures = [socket.error(32, 'Broken pipe'),
+            socket.error(111, 'Connection refused')]
+        self.assertRaises(httppool.PoolException, self.pool.request,
+            'GET', '/b')
+        self.assertEqual(self.pool.stats.statuses, {httplib.OK: 1, None: 1})
+        self.assertEqual(self.pool.stats.requests, 2)
+        self.assertTrue(self.pool.stats.mean_latency >= 0)
+
+
+class TestGetPool(unittest.TestCase):
+
+    def test_pools_are_shared(self):
+        pool = httppool.get_pool('https://example.com:8443/')
+        self.assertTrue(httppool.get_pool('https://example.com:8443/') is pool)
+        self.assertEqual(pool.host, 'example.com:8443')
+        self.assertEqual(pool.connection_class, httplib.HTTPSConnection)
+
+    def test_http_is_default(self):
+        pool = httppool.get_pool('example.org')
+        self.assertEqual(pool.host, 'example.org')
+        self.assertEqual(pool.connection_class, httplib.HTTPConnection)
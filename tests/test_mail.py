@@ -0,0 +1,230 @@
+import os
+import shutil
+import tempfile
+import unittest
+import smtplib
+import email
+from mock import Mock
+
+from handlers.mail.smtp import SMTPPool
+from handlers.mail.handler import MailHandler
+from registry import Rule
+from outbox import Outbox
+
+
+class FakeSMTP():
+    """Stands in for smtplib.SMTP. Instances are recorded so that tests
+    can check how many sessions have been opened.
+    """
+
+    instances = []
+    failures = []
+
+    def __init__(self, host, timeout=None):
+        self.host = host
+        self.sock = object()
+        self.alive = True
+        self.commands = []
+        self.mails = []
+        FakeSMTP.instances.append(self)
+
+    def ehlo(self):
+        self.commands.append('ehlo')
+
+    def starttls(self):
+        self.commands.append('starttls')
+
+    def login(self, username, password):
+        self.commands.append('login ' + username)
+
+    def noop(self):
+        self.commands.append('noop')
+        if not self.alive:
+            raise smtplib.SMTPServerDisconnected()
+        return 250, 'OK'
+
+    def sendmail(self, sender, recipients, message):
+        if FakeSMTP.failures:
+            raise FakeSMTP.failures.pop(0)
+        self.mails.append((sender, recipients, message))
+        return {}
+
+    def quit(self):
+        self.commands.append('quit')
+        self.close()
+
+    def close(self):
+        self.sock = None
+
+
+class TestSMTPPool(unittest.TestCase):
+
+    def setUp(self):
+        FakeSMTP.instances = []
+        FakeSMTP.failures = []
+        self.pool = SMTPPool('mail.example.com', size=2, idle_timeout=60,
+            smtp_class=FakeSMTP)
+
+    def test_session_is_reused(self):
+        self.pool.sendmail('a@example.com', ['b@example.com'], 'first')
+        self.pool.sendmail('a@example.com', ['c@example.com'], 'second')
+        self.assertEqual(len(FakeSMTP.instances), 1)
+        self.assertEqual(FakeSMTP.instances[0].commands, ['noop'])
+        self.assertEqual(len(FakeSMTP.instances[0].mails), 2)
+
+    def test_dead_session_is_replaced(self):
+        self.pool.sendmail('a@example.com', ['b@example.com'], 'first')
+        FakeSMTP.instances[0].alive = False
+        self.pool.sendmail('a@example.com', ['b@example.com'], 'second')
+        self.assertEqual(len(FakeSMTP.instances), 2)
+        self.assertEqual(FakeSMTP.instances[1].mails,
+            [('a@example.com', ['b@example.com'], 'second')])
+
+    def test_resend_after_disconnect(self):
+        self.pool.sendmail('a@example.com', ['b@example.com'], 'first')
+        FakeSMTP.failures = [smtplib.SMTPServerDisconnected()]
+        self.pool.sendmail('a@example.com', ['b@example.com'], 'second')
+        self.assertEqual(len(FakeSMTP.instances), 2)
+        self.assertEqual(len(FakeSMTP.instances[1].mails), 1)
+
+    def test_fresh_session_failure_raises(self):
+        FakeSMTP.failures = [smtplib.SMTPServerDisconnected()]
+        self.assertRaises(smtplib.SMTPServerDisconnected,
+            self.pool.sendmail, 'a@example.com', ['b@example.com'], 'mail')
+        self.assertEqual(self.pool._idle, [])
+
+    def test_session_is_kept_after_refused_recipients(self):
+        FakeSMTP.failures = [smtplib.SMTPRecipientsRefused({})]
+        self.assertRaises(smtplib.SMTPRecipientsRefused,
+            self.pool.sendmail, 'a@example.com', ['b@example.com'], 'mail')
+        self.pool.sendmail('a@example.com', ['c@example.com'], 'mail')
+        self.assertEqual(len(FakeSMTP.instances), 1)
+
+    def test_starttls_and_login(self):
+        self.pool.starttls = True
+        self.pool.username = 'notifier'
+        self.pool.sendmail('a@example.com', ['b@example.com'], 'mail')
+        self.assertEqual(FakeSMTP.instances[0].commands,
+            ['ehlo', 'starttls', 'ehlo', 'login notifier'])
+
+    def test_close_quits_idle_sessions(self):
+        self.pool.sendmail('a@example.com', ['b@example.com'], 'mail')
+        self.pool.close()
+        self.assertEqual(FakeSMTP.instances[0].commands, ['quit'])
+        self.assertEqual(self.pool._idle, [])
+
+
+class FakeMessage():
+
+    def __init__(self, events):
+        self.events = events
+        self.title = u'Story #1'
+        self.content = u'<html><body><p>Content</p></body></html>'
+        self.content_plain = u'Content'
+
+
+class MailTestCase(unittest.TestCase):
+    """Sends mails through an outbox in a temporary directory, which has
+    to be emptied with deliver_due().
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.outbox = Outbox(os.path.join(self.directory, 'outbox.db'))
+        self.pool = Mock()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+class TestMailHandler(MailTestCase):
+
+    def setUp(self):
+        MailTestCase.setUp(self)
+        self.handler = MailHandler(Rule(events=1),
+            lambda msg: set(['a@example.com', 'b@example.com']), self.pool,
+            outbox=self.outbox)
+        self.handler.register_channels()
+        self.handler.add_rule(Rule(events=2),
+            lambda msg: set(['b@example.com', 'c@example.com']))
+
+    def test_single_mail_to_all_recipients(self):
+        self.handler.handle(FakeMessage(3))
+        self.outbox.deliver_due()
+        self.assertEqual(self.pool.sendmail.call_count, 1)
+        self.assertEqual(self.pool.sendmail.call_args[0][1],
+            ['a@example.com', 'b@example.com', 'c@example.com'])
+
+    def test_recipients_of_matching_rules_only(self):
+        self.handler.handle(FakeMessage(2))
+        self.outbox.deliver_due()
+        self.assertEqual(self.pool.sendmail.call_args[0][1],
+            ['b@example.com', 'c@example.com'])
+        self.handler.handle(FakeMessage(4))
+        self.outbox.deliver_due()
+        self.assertEqual(self.pool.sendmail.call_count, 1)
+
+    def test_rules_are_merged(self):
+        self.assertEqual(self.handler.interested_in.events, 3)
+
+    def test_rejected_mail_is_not_retried(self):
+        self.pool.sendmail.side_effect = smtplib.SMTPRecipientsRefused({})
+        self.handler.handle(FakeMessage(1))
+        self.outbox.deliver_due()
+        self.assertEqual(len(self.outbox), 0)
+        self.assertEqual(len(self.outbox.dead_letters()), 1)
+
+    def test_mail_is_retried_after_disconnect(self):
+        self.pool.sendmail.side_effect = smtplib.SMTPServerDisconnected()
+        self.handler.handle(FakeMessage(1))
+        self.outbox.deliver_due()
+        self.assertEqual(len(self.outbox), 1)
+
+
+class TestDigests(MailTestCase):
+
+    def setUp(self):
+        MailTestCase.setUp(self)
+        self.handler = MailHandler(Rule(events=1),
+            lambda msg: set(['a@example.com']), self.pool,
+            digest_window=60, digest_max=3, outbox=self.outbox)
+        self.handler.register_channels()
+        self.handler.add_rule(Rule(events=2),
+            lambda msg: set(['b@example.com']))
+
+    def tearDown(self):
+        self.handler.close()
+        MailTestCase.tearDown(self)
+
+    def recipients(self):
+        self.outbox.deliver_due()
+        return [call[0][1] for call in self.pool.sendmail.call_args_list]
+
+    def test_messages_are_collected(self):
+        self.handler.handle(FakeMessage(1))
+        self.handler.handle(FakeMessage(3))
+        self.assertEqual(self.pool.sendmail.call_count, 0)
+        self.assertTrue(self.handler._timer.scheduled)
+        self.handler.close()
+        self.assertEqual(sorted(self.recipients()),
+            [['a@example.com'], ['b@example.com']])
+        self.assertFalse(self.handler._timer.scheduled)
+
+    def test_same_digest_is_sent_once(self):
+        self.handler.handle(FakeMessage(3))
+        self.handler.handle(FakeMessage(3))
+        self.handler.flush(force=True)
+        self.assertEqual(self.recipients(),
+            [['a@example.com', 'b@example.com']])
+        mail = self.pool.sendmail.call_args[0][2]
+        self.assertTrue(mail.find('Subject: 2 changes, latest: Story #1') > 0)
+        html = [part for part in email.message_from_string(mail).walk()
+            if part.get_content_type() == 'text/html'][0]
+        self.assertEqual(html.get_payload(decode=True),
+            '<html><body><p>Content</p><hr/><p>Content</p></body></html>')
+
+    def test_full_digest_is_sent(self):
+        for _ in range(3):
+            self.handler.handle(FakeMessage(1))
+        self.handler.handle(FakeMessage(2))
+        self.assertEqual(self.recipients(), [['a@example.com']])
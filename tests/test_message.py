@@ -3,6 +3,8 @@
 import unittest
 from mock import Mock
 import json
+import pickle
+from datetime import datetime
 
 import sleekxmpp
 
@@ -34,7 +36,7 @@ class TestMessage(unittest.TestCase):
         
     def test_msg_1_data_from_xmpp_message(self):
         msg = message.AZMessage(self.xmpp_msg_1)
-        message.api.get_story.assert_called_with(12345, 1)
+        self.assertFalse(message.api.get_story.called)
         
         self.assertEqual(msg.project_id, 12345)
         self.assertEqual(msg.story_id, 1)
@@ -53,17 +55,55 @@ class TestMessage(unittest.TestCase):
     
     def test_msg_1_data_from_api(self):
         msg = message.AZMessage(self.xmpp_msg_1)
-        message.api.get_story.assert_called_once_with(12345, 1)
-        self.assertFalse(message.api.lookup_project_id.called)
         self.assertEqual(msg.status, 'started')
         self.assertEqual(msg.creator, 'Gob Bluth')
         self.assertEqual(msg.creator_mail, 'Gob@bluth.com')
+        message.api.get_story.assert_called_once_with(12345, 1)
+        self.assertFalse(message.api.lookup_project_id.called)
         self.assertTrue(msg.content is not None)
         self.assertTrue(msg.content_plain is not None)
 
+    def test_content_is_rendered_lazily(self):
+        msg = message.AZMessage(self.xmpp_msg_1)
+        self.assertFalse('content' in msg.__dict__)
+        self.assertFalse('content_plain' in msg.__dict__)
+        content = msg.content
+        self.assertTrue('Build Spec house' in content)
+        self.assertTrue(msg.content is content)
+
+    def test_pickle_contains_content_but_not_story(self):
+        msg = message.AZMessage(self.xmpp_msg_1)
+        restored = pickle.loads(pickle.dumps(msg))
+        self.assertFalse('_story' in restored.__dict__)
+        self.assertEqual(restored.status, 'started')
+        self.assertEqual(restored.content, msg.content)
+        self.assertEqual(restored.content_plain, msg.content_plain)
+        self.assertEqual(restored.guid, msg.guid)
+
+    def test_message_of_earlier_version_is_restored(self):
+        msg = pickle.loads(baseline_pickle(BASELINE_STATE))
+        self.assertEqual(msg.events, message.NEW)
+        self.assertEqual(msg.status, 'started')
+        restored = pickle.loads(pickle.dumps(msg))
+        self.assertEqual(restored.content, BASELINE_STATE['content'])
+        self.assertFalse(message.api.get_story.called)
+
+    def test_story_is_loaded_once(self):
+        msg = message.AZMessage(self.xmpp_msg_1)
+        msg.status, msg.creator, msg.content
+        self.assertEqual(message.api.get_story.call_count, 1)
+
+    def test_invalid_story_data(self):
+        del self.story_2['creator']
+        msg = message.AZMessage(self.xmpp_msg_1)
+        self.assertTrue(msg.is_marked_blocked() is False)
+        self.assertRaises(message.MessageCreationException,
+            getattr, msg, 'creator')
+
     def test_msg_2_lookup_project(self):
         msg = message.AZMessage(self.xmpp_msg_2)
         message.api.lookup_project_id.assert_called_once_with('ProjectFoo')
+        self.assertEqual(msg.text, 'Build Spec house')
         message.api.get_story.assert_called_once_with(99999, 2)
         self.assertEqual(msg.project_id, 99999)
         self.assertEqual(msg.story_id, 2)
@@ -88,6 +128,19 @@ class TestMessage(unittest.TestCase):
         self.assertFalse(msg.is_marked_blocked())
         self.assertFalse(msg.is_marked_deployed())
 
+    def test_classify(self):
+        self.assertEqual(message.classify('"X" (#1) was blocked by A B'),
+            message.MARKED_BLOCKED)
+        self.assertEqual(message.classify(
+            '"X" (#1) was moved from Ready to Deployed by A B'),
+            message.MARKED_DEPLOYED)
+        self.assertEqual(message.classify(
+            '"X" (#1) was moved from Backlog to Ready by A B'),
+            message.MOVED_TO_READY)
+        self.assertEqual(message.classify('"X" (#1) was created by A B'),
+            message.NEW)
+        self.assertEqual(message.classify('Comment by A B on "X" (#1)'), 0)
+
     def test_invalid_msg_data(self):
         xmpp_msg = sleekxmpp.Message()
         xmpp_msg['html'].set_body('<html><body><p>empty</p></body></html>')
@@ -214,4 +267,46 @@ STORY_2_JSON = '{\
       }\
     }\
   ]\
-}'
\ No newline at end of file
+}'
+
+
+# the state of a message pickled by versions before lazy loading
+BASELINE_STATE = {
+    'title': u'[TestProject] "Story" (#1) was created by John Doe',
+    'pubdate': datetime(2011, 1, 1),
+    'project_id': 12345,
+    'story_id': 1,
+    'categories': [],
+    'text': u'Story',
+    'tags': [],
+    'status': u'started',
+    'color': u'grey',
+    'creator': u'Gob Bluth',
+    'creator_mail': u'Gob@bluth.com',
+    'content': u'<html><body>Story</body></html>',
+    'content_plain': u'Story',
+    'link': 'https://agilezen.com/project/12345/story/1',
+    'guid': 'https://agilezen.com/project/12345/story/1#ID_1',
+    'causer': 'John Doe' }
+
+def baseline_pickle(obj):
+    """Pickle obj like earlier versions did, where an AZMessage is a plain
+    instance (without __getstate__) with the given state.
+    """
+    class AZMessage:
+        pass
+    def _message(state):
+        instance = AZMessage()
+        instance.__dict__.update(state)
+        return instance
+    if isinstance(obj, list):
+        obj = [_message(state) for state in obj]
+    else:
+        obj = _message(obj)
+    current = message.AZMessage
+    message.AZMessage = AZMessage
+    AZMessage.__module__ = 'message'
+    try:
+        return pickle.dumps(obj)
+    finally:
+        message.AZMessage = current
@@ -0,0 +1,109 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from outbox import Outbox, PermanentFailure
+
+
+class TestOutbox(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.outbox = self.new_outbox()
+        self.delivered = []
+        self.failures = []
+        self.outbox.register('test', self.deliver)
+
+    def tearDown(self):
+        self.outbox.stop()
+        shutil.rmtree(self.directory)
+
+    def new_outbox(self):
+        return Outbox(os.path.join(self.directory, 'outbox.db'), workers=1,
+            max_attempts=3, backoff=0.01)
+
+    def deliver(self, payload):
+        if self.failures:
+            raise self.failures.pop(0)
+        self.delivered.append(payload)
+
+    def test_delivery(self):
+        self.outbox.put('test', ('a', 1))
+        self.assertEqual(len(self.outbox), 1)
+        self.assertEqual(self.outbox.deliver_due(), 1)
+        self.assertEqual(self.delivered, [('a', 1)])
+        self.assertEqual(len(self.outbox), 0)
+
+    def test_deliveries_are_persistent(self):
+        self.outbox.put('test', 'a')
+        restored = self.new_outbox()
+        restored.register('test', self.deliver)
+        restored.deliver_due()
+        self.assertEqual(self.delivered, ['a'])
+
+    def test_unregistered_channel_is_kept(self):
+        self.outbox.put('other', 'a')
+        self.assertEqual(self.outbox.deliver_due(), 0)
+        self.assertEqual(len(self.outbox), 1)
+
+    def test_pending_channels(self):
+        self.outbox.put('test', 'a')
+        self.outbox.put('other', 'b')
+        self.outbox.put('other', 'c')
+        self.assertEqual(sorted(self.outbox.pending_channels()),
+            ['other', 'test'])
+
+    def test_failed_delivery_is_retried_later(self):
+        self.failures = [IOError('down')]
+        self.outbox.put('test', 'a')
+        self.assertEqual(self.outbox.deliver_due(), 1)
+        self.assertEqual(self.delivered, [])
+        time.sleep(0.02)
+        self.outbox.deliver_due()
+        self.assertEqual(self.delivered, ['a'])
+
+    def test_dead_letters(self):
+        self.failures = [PermanentFailure('rejected')]
+        self.outbox.put('test', 'a')
+        self.outbox.deliver_due()
+        self.assertEqual(self.outbox.dead_letters(),
+            [('test', 'a', 'PermanentFailure: rejected')])
+        self.assertEqual(len(self.outbox), 0)
+
+    def test_gives_up_after_max_attempts(self):
+        self.outbox.backoff = 0
+        self.failures = [IOError('down')] * 3
+        self.outbox.put('test', 'a')
+        self.assertEqual(self.outbox.deliver_due(), 3)
+        self.assertEqual(len(self.outbox.dead_letters()), 1)
+
+    def test_workers(self):
+        self.outbox.start()
+        self.failures = [IOError('down')]
+        for payload in ('a', 'b'):
+            self.outbox.put('test', payload)
+        deadline = time.time() + 5
+        while len(self.delivered) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(sorted(self.delivered), ['a', 'b'])
+
+    def test_concurrency_limit(self):
+        self.outbox.register('test', self.deliver, concurrency=1)
+        for payload in ('a', 'b'):
+            self.outbox.put('test', payload)
+        delivery = self.outbox._take(time.time())
+        self.assertTrue(self.outbox._take(time.time()) is None)
+        self.assertTrue(self.outbox._next_due(time.time()) is None)
+        self.outbox._deliver(delivery)
+        self.assertEqual(self.outbox.deliver_due(), 1)
+
+    def test_rate_limit(self):
+        self.outbox.register('test', self.deliver, rate_limit=10)
+        for payload in ('a', 'b'):
+            self.outbox.put('test', payload)
+        self.assertEqual(self.outbox.deliver_due(), 1)
+        self.assertTrue(0 < self.outbox._next_due(time.time()) <= 0.1)
+        time.sleep(0.1)
+        self.assertEqual(self.outbox.deliver_due(), 1)
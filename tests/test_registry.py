@@ -0,0 +1,88 @@
+import unittest
+
+from registry import Rule, HandlerRegistry, any_of
+
+
+class FakeMessage():
+
+    def __init__(self, project_id, events):
+        self.project_id = project_id
+        self.events = events
+
+
+class FakeHandler():
+
+    def __init__(self, interested_in=None):
+        if interested_in is not None:
+            self.interested_in = interested_in
+
+
+class TestRule(unittest.TestCase):
+
+    def test_keys(self):
+        rule = Rule(events=1 | 4, project_ids=[7])
+        self.assertTrue(rule(FakeMessage(7, 4)))
+        self.assertFalse(rule(FakeMessage(7, 2)))
+        self.assertFalse(rule(FakeMessage(8, 1)))
+
+    def test_refining_predicate(self):
+        rule = Rule(events=1, test=lambda msg: msg.project_id > 5)
+        self.assertTrue(rule(FakeMessage(7, 1)))
+        self.assertFalse(rule(FakeMessage(3, 1)))
+        self.assertTrue(Rule()(FakeMessage(3, 0)))
+
+
+class TestHandlerRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.new = FakeHandler(Rule(events=1))
+        self.blocked_or_new = FakeHandler(Rule(events=2 | 1))
+        self.project_1 = FakeHandler(Rule(project_ids=[1]))
+        self.project_2 = FakeHandler(Rule(project_ids=[2]))
+        self.always = FakeHandler(Rule())
+        self.callable = FakeHandler(lambda msg: True)
+        self.printer = FakeHandler()
+        self.registry = HandlerRegistry([self.new, self.blocked_or_new,
+            self.project_1, self.project_2, self.always, self.callable,
+            self.printer])
+
+    def test_all_handlers(self):
+        self.assertEqual(len(self.registry), 7)
+        self.assertEqual(list(self.registry)[0], self.new)
+
+    def test_match_by_project_and_event(self):
+        self.assertEqual(self.registry.match(FakeMessage(1, 1)),
+            [self.new, self.blocked_or_new, self.project_1, self.always,
+                self.callable, self.printer])
+
+    def test_match_unindexed_only(self):
+        self.assertEqual(self.registry.match(FakeMessage(3, 8)),
+            [self.always, self.callable, self.printer])
+
+    def test_match_multiple_events(self):
+        self.assertEqual(self.registry.match(FakeMessage(2, 3))[:3],
+            [self.new, self.blocked_or_new, self.project_2])
+
+
+class TestAnyOf(unittest.TestCase):
+
+    def test_union_of_events(self):
+        rule = any_of([Rule(events=1), Rule(events=4)])
+        self.assertEqual(rule.events, 5)
+        self.assertTrue(rule.test is None)
+        self.assertTrue(rule(FakeMessage(1, 4)))
+
+    def test_union_of_projects_with_test(self):
+        rule = any_of([Rule(project_ids=[1]),
+            Rule(project_ids=[2], test=lambda msg: msg.events == 0)])
+        self.assertEqual(rule.project_ids, frozenset([1, 2]))
+        self.assertTrue(rule(FakeMessage(1, 1)))
+        self.assertTrue(rule(FakeMessage(2, 0)))
+        self.assertFalse(rule(FakeMessage(2, 1)))
+
+    def test_mixed_keys(self):
+        rule = any_of([Rule(project_ids=[1]), Rule(events=2)])
+        self.assertTrue(rule.project_ids is None and rule.events is None)
+        self.assertTrue(rule(FakeMessage(1, 1)))
+        self.assertTrue(rule(FakeMessage(2, 2)))
+        self.assertFalse(rule(FakeMessage(2, 1)))
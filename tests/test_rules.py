@@ -0,0 +1,143 @@
+import unittest
+import StringIO
+from ConfigParser import RawConfigParser
+from mock import Mock
+
+import rules
+
+
+RULES = """
+[mail:ready]
+events = moved_to_ready, new
+recipients = active_members_without_creator
+
+[feed:all]
+title = All
+
+[feed:projects]
+per_project = yes
+title = Project {project_id}
+filename = project-{project_id}
+projects = 2, 1
+"""
+
+
+class FakeFeedHandler():
+
+    def __init__(self, title, filename, interested_in, cache_size=None):
+        self.title = title
+        self.filename = filename
+        self.interested_in = interested_in
+        self.cache_size = cache_size
+
+    def resize(self, cache_size):
+        self.cache_size = cache_size
+
+    def reconfigure(self, title, interested_in):
+        self.title = title
+        self.interested_in = interested_in
+
+
+class TestCompileRules(unittest.TestCase):
+
+    def setUp(self):
+        self.feed_handler = rules.FeedHandler
+        rules.FeedHandler = FakeFeedHandler
+
+    def tearDown(self):
+        rules.FeedHandler = self.feed_handler
+
+    def test_compile(self):
+        handlers = list(rules.compile_rules(_config(RULES)))
+        self.assertEqual(len(handlers), 4)
+        mail = handlers[0]
+        self.assertTrue(isinstance(mail, rules.MailHandler))
+        self.assertEqual(mail.interested_in.events,
+            rules.MOVED_TO_READY | rules.NEW)
+        self.assertEqual(mail.rules[0][1],
+            rules.active_members_without_creator)
+        self.assertEqual(handlers[1].title, u'All')
+        self.assertEqual(handlers[1].filename, 'all')
+        self.assertEqual(
+            [(each.title, each.filename) for each in handlers[2:]],
+            [('Project 1', 'project-1'), ('Project 2', 'project-2')])
+        self.assertEqual(handlers[3].interested_in.project_ids,
+            frozenset([2]))
+
+    def test_unchanged_handlers_are_reused(self):
+        previous = rules.compile_rules(_config(RULES))
+        changed = RULES.replace('projects = 2, 1', 'projects = 3, 1')
+        handlers = list(rules.compile_rules(_config(changed), previous))
+        self.assertTrue(handlers[0] is list(previous)[0])
+        self.assertTrue(handlers[2] is list(previous)[2])
+        self.assertEqual(handlers[3].filename, 'project-3')
+
+    def test_cache_size_of_reused_feed_is_changed(self):
+        previous = rules.compile_rules(_config('[feed:all]'))
+        handlers = list(rules.compile_rules(
+            _config('[feed:all]\nmessage_cache_size = 5'), previous))
+        self.assertTrue(handlers[0] is list(previous)[0])
+        self.assertEqual(handlers[0].cache_size, 5)
+
+    def test_feed_of_same_file_is_reused(self):
+        previous = rules.compile_rules(_config('[feed:all]'))
+        handlers = list(rules.compile_rules(
+            _config('[feed:all]\ntitle = Everything\nevents = new'),
+            previous))
+        self.assertTrue(handlers[0] is list(previous)[0])
+        self.assertEqual(handlers[0].title, u'Everything')
+        self.assertEqual(handlers[0].interested_in.events, rules.NEW)
+
+    def test_per_project_feeds_for_active_projects(self):
+        get_active_project_ids = rules.api.get_active_project_ids
+        rules.api.get_active_project_ids = Mock(return_value=[5])
+        try:
+            handlers = list(rules.compile_rules(_config(
+                '[feed:p]\nper_project = true\nfilename = p{project_id}')))
+        finally:
+            rules.api.get_active_project_ids = get_active_project_ids
+        self.assertEqual(handlers[0].filename, 'p5')
+
+    def test_mail_rules_are_merged(self):
+        text = RULES + '[mail:blocked]\nevents = marked_blocked\n' \
+            'recipients = everyone\n'
+        previous = rules.compile_rules(_config(text))
+        handlers = list(previous)
+        self.assertEqual(len(handlers), 4)
+        mail = handlers[0]
+        self.assertEqual([recipients for _, recipients in mail.rules],
+            [rules.active_members_without_creator, rules.everyone])
+        self.assertEqual(mail.interested_in.events,
+            rules.MOVED_TO_READY | rules.NEW | rules.MARKED_BLOCKED)
+        reused = list(rules.compile_rules(_config(text), previous))
+        self.assertTrue(reused[0] is mail)
+
+    def test_webhook_endpoints(self):
+        handlers = list(rules.compile_rules(_config(
+            '[webhook:a]\nfields = story_id, text\nrate_limit = 2\n'
+            '[webhook:b]\nhost = https://b.example.com')))
+        self.assertEqual([each.channel for each in handlers],
+            ['webhook:a', 'webhook:b'])
+        self.assertEqual(handlers[0].fields, ('story_id', 'text'))
+        self.assertEqual(handlers[1].fields, rules.FIELDS)
+
+    def test_invalid_rules(self):
+        for text in ('[foo:bar]',
+                '[mail:x]\nrecipients = nobody',
+                '[mail:x]\nrecipients = everyone\nevents = exploded',
+                '[feed:x]\nprojects = one',
+                '[feed:x]\ncolor = red',
+                '[feed:x]\nper_project = maybe',
+                '[webhook:x]\nfields = color',
+                '[webhook:x]\nconcurrency = many',
+                '[feed:a]\n[feed:b]\nfilename = a',
+                '[feed:p-1]\n[feed:p]\nper_project = yes\n'
+                    'filename = p-{project_id}\nprojects = 1'):
+            self.assertRaises(rules.RuleConfigException,
+                rules.compile_rules, _config(text))
+
+
+def _config(text):
+    config = RawConfigParser()
+    config.readfp(StringIO.StringIO(text))
+    return config
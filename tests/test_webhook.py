@@ -0,0 +1,174 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from mock import Mock
+
+import httppool
+from outbox import Outbox
+from handlers.webhook.handler import WebhookHandler, Payloads, \
+    register_webhooks
+
+
+class FakeMessage():
+
+    project_id = 1
+    story_id = 2
+    text = u'Story'
+    status = 'ready'
+    tags = []
+    creator = 'John Doe'
+    creator_mail = 'john@example.com'
+
+
+class CountingMessage(object):
+    """Counts the reads of its text."""
+
+    project_id = 1
+    story_id = 2
+    reads = 0
+
+    @property
+    def text(self):
+        self.reads += 1
+        return u'Story'
+
+
+class WebhookTestCase(unittest.TestCase):
+    """Sends requests through an outbox in a temporary directory to a fake
+    pool.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.outbox = Outbox(os.path.join(self.directory, 'outbox.db'))
+        self.pool = Mock()
+        self.pool.request.return_value = (200, '')
+        httppool._POOLS['https://hook.test'] = self.pool
+        self.handler = WebhookHandler(lambda msg: True, 'https://hook.test',
+            '/events', outbox=self.outbox)
+        self.handler.register_channels()
+
+    def tearDown(self):
+        del httppool._POOLS['https://hook.test']
+        shutil.rmtree(self.directory)
+
+
+class TestWebhookHandler(WebhookTestCase):
+
+    def test_request(self):
+        self.handler.handle(FakeMessage())
+        self.outbox.deliver_due()
+        method, path, body, headers = self.pool.request.call_args[0]
+        self.assertEqual((method, path), ('PUT', '/events'))
+        self.assertEqual(json.loads(body)['story_id'], 2)
+        self.assertEqual(len(self.outbox), 0)
+
+    def test_server_error_is_retried(self):
+        self.pool.request.return_value = (503, '')
+        self.handler.handle(FakeMessage())
+        self.outbox.deliver_due()
+        self.assertEqual(len(self.outbox), 1)
+
+    def test_rejected_request_is_not_retried(self):
+        self.pool.request.return_value = (404, '')
+        self.handler.handle(FakeMessage())
+        self.outbox.deliver_due()
+        self.assertEqual(len(self.outbox), 0)
+        self.assertEqual(len(self.outbox.dead_letters()), 1)
+
+
+class TestEndpoints(WebhookTestCase):
+
+    def test_fields(self):
+        handler = WebhookHandler(lambda msg: True, 'https://hook.test',
+            '/ids', outbox=self.outbox, fields=('project_id', 'story_id'))
+        handler.register_channels()
+        handler.handle(FakeMessage())
+        self.outbox.deliver_due()
+        self.assertEqual(json.loads(self.pool.request.call_args[0][2]),
+            {'project_id': 1, 'story_id': 2})
+
+    def test_named_endpoint_has_own_channel(self):
+        handler = WebhookHandler(lambda msg: True, 'https://hook.test',
+            '/events', outbox=self.outbox, name='other', concurrency=2)
+        handler.register_channels()
+        self.assertEqual(handler.channel, 'webhook:other')
+        self.assertEqual(self.outbox._channels['webhook:other'].concurrency,
+            2)
+
+    def test_payload_is_serialized_once(self):
+        payloads = Payloads(size=1)
+        message = CountingMessage()
+        fields = ('story_id', 'text')
+        first = payloads.get(message, fields)
+        self.assertTrue(payloads.get(message, fields) is first)
+        self.assertEqual(message.reads, 1)
+        payloads.get(CountingMessage(), fields)
+        self.assertFalse(payloads.get(message, fields) is first)
+
+    def test_fields_are_read_without_lock(self):
+        payloads = Payloads()
+        locked = []
+        class LoadingMessage(object):
+            @property
+            def text(self):
+                locked.append(not payloads._lock.acquire(False))
+                if not locked[-1]:
+                    payloads._lock.release()
+                return u'Story'
+        payloads.get(LoadingMessage(), ('text', ))
+        self.assertEqual(locked, [False])
+
+    def test_body_is_serialized_once(self):
+        payloads = Payloads()
+        message = FakeMessage()
+        body = payloads.body(message, ('story_id', ))
+        self.assertEqual(json.loads(body), {'story_id': 2})
+        self.assertTrue(payloads.body(message, ('story_id', )) is body)
+
+    def test_requests_of_removed_endpoints_are_sent(self):
+        self.outbox.put('webhook:removed',
+            ('https://hook.test', '/events', '{}'))
+        self.outbox.put('other', 'kept')
+        register_webhooks(self.outbox)
+        self.assertEqual(self.outbox.deliver_due(), 1)
+        self.assertEqual(sorted(self.outbox._channels),
+            ['webhook', 'webhook:removed'])
+
+
+class TestBatches(WebhookTestCase):
+
+    def setUp(self):
+        WebhookTestCase.setUp(self)
+        self.handler.batch_size = 3
+        self.handler.batch_interval = 60
+
+    def tearDown(self):
+        self.handler.close()
+        WebhookTestCase.tearDown(self)
+
+    def bodies(self):
+        self.outbox.deliver_due()
+        return [json.loads(call[0][2])
+            for call in self.pool.request.call_args_list]
+
+    def test_request(self):
+        for _ in range(3):
+            self.handler.handle(FakeMessage())
+        self.assertEqual([len(body) for body in self.bodies()], [3])
+        self.assertFalse(self.handler._timer.scheduled)
+
+    def test_batch_is_sent_on_close(self):
+        self.handler.handle(FakeMessage())
+        self.assertEqual(self.bodies(), [])
+        self.handler.close()
+        self.assertEqual([len(body) for body in self.bodies()], [1])
+
+    def test_batch_is_retried(self):
+        self.pool.request.return_value = (503, '')
+        for _ in range(3):
+            self.handler.handle(FakeMessage())
+        self.outbox.deliver_due()
+        self.assertEqual(len(self.outbox), 1)